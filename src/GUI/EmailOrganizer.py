@@ -1,9 +1,8 @@
-import json
-import os
 import threading
 import customtkinter as ctk
 
 from src.GUI.AppStyles import *
+from src import sender_store
 from src.email_organizer import email_organizer
 
 class EmailOrganizer(ctk.CTkFrame):
@@ -30,15 +29,7 @@ class EmailOrganizer(ctk.CTkFrame):
         self.pack(padx=12, pady=12, fill="both", expand=True)
     
     def check_has_scanned_senders(self):
-        file_exists = os.path.exists("src/data/senders.json")
-        if file_exists:
-            with open("src/data/senders.json", "r") as file:
-                if len(json.load(file)) == 0: return False
-                else: return True
-        elif not file_exists:
-            with open("src/data/senders.json", "w") as file:
-                json.dump([], file, indent=4)
-            return False
+        return sender_store.has_senders()
 
     def check_has_rules(self):
         """
@@ -47,19 +38,7 @@ class EmailOrganizer(ctk.CTkFrame):
 
         @return: bool indicating if any rules have been setup.
         """
-        if os.path.exists("src/data/sender_labels.json"):
-            with open("src/data/sender_labels.json", "r") as file:
-                data = json.load(file)
-                for sender in data:
-                    if(sender not in ["Filter by Label", "---"]):
-                        if(len(data[sender]) > 0):
-                            return True
-        
-        if os.path.exists("src/data/unsubscribed.json"):
-            with open("src/data/unsubscribed.json", "r") as file:
-                data = json.load(file)
-                if(len(data) > 0): return True
-        return False
+        return sender_store.has_rules()
 
     def init_descs(self):
         self.desc1 = ctk.CTkLabel(master=self,
@@ -156,7 +135,10 @@ class EmailOrganizer(ctk.CTkFrame):
         self.after(100, self.check_scan_status)
 
     def run_scan(self):
-        email_organizer(self.scan_cancel_flag, self.update_scan_progress)
+        try:
+            email_organizer(self.scan_cancel_flag, self.update_scan_progress)
+        except Exception as e:
+            print(f"Error organizing emails: {e}")
 
     def update_scan_progress(self, progress, n, total, rate, elapsed):
         if(n==0): return
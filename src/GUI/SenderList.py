@@ -1,17 +1,16 @@
-from email.header import decode_header
-import os, json
-import quopri
-import re
 import customtkinter as ctk
 import threading
 from PIL import Image
 
-from ..sender_scan import BATCH_SIZE, scan_for_senders
+from .. import sender_store
+from ..sender_scan import has_scan_checkpoint, scan_for_senders
 from ..SenderEntry import SenderEntry
-from ..rm_from_sender import rm_from_sender
+from ..rm_from_sender import rm_from_senders
 
 from .AppStyles import *
 
+DELETE_QUEUE_DELAY = 1000  # ms to wait for more senders to be queued before deleting them
+
 class SenderList(ctk.CTkFrame):
     def __init__(self, master):
         super().__init__(
@@ -32,10 +31,13 @@ class SenderList(ctk.CTkFrame):
         self.scan_cancel_flag = threading.Event()
         self.scan_pbar = None
         self.scan_pbar_label_1 = None
+        self.scan_results_label = None
 
         self.delete_sender_thread = None
-        self.delete_sender_pbar = None
-        self.delete_sender_address = None
+        self.delete_queue = {}  # address -> progress bar, for the senders waiting to be deleted
+        self.delete_batch = {}  # address -> progress bar, for the senders being deleted
+        self.delete_batch_scheduled = False
+        self.deleted_senders = None
 
         self.exit_search_button = None
 
@@ -46,14 +48,7 @@ class SenderList(ctk.CTkFrame):
 
     
     def check_has_scanned(self):
-        if os.path.exists("src/data/senders.json"):
-            with open("src/data/senders.json", "r") as file:
-                try:
-                    data = json.load(file)
-                    if data: return True
-                    return False
-                except: return False
-        return False
+        return sender_store.has_senders()
 
     def init_descs(self):
         self.desc_1 = ctk.CTkLabel(
@@ -102,7 +97,7 @@ class SenderList(ctk.CTkFrame):
             master=self.scan_frame,
             height=50,
             width=300,
-            text="Start Scan",
+            text="Resume Scan" if has_scan_checkpoint() else "Start Scan",
             font=("Switzer Black", 28),
             fg_color=DARK_BLUE_HOVER,
             hover_color=DARK_BLUE,
@@ -200,28 +195,9 @@ class SenderList(ctk.CTkFrame):
         self.current_page = 1
         self.after(0, self.display_senders)
 
-    def load_senders(self):
-        with open("src/data/senders.json", "r") as file:
-            senders_data = json.load(file)
-        
-        eq_reg = re.compile(r'^=\?')
-        for sender in senders_data:
-            raw_name = senders_data[sender]['name']
-            if eq_reg.match(raw_name):
-                decoded_parts = decode_header(raw_name)
-                decoded_name = ''
-                for part, encoding in decoded_parts:
-                    if isinstance(part, bytes):
-                        if encoding:
-                            decoded_name += part.decode(encoding)
-                        else:
-                            decoded_name += quopri.decodestring(part).decode('utf-8', errors='ignore')
-                    else:
-                        decoded_name += part
-                
-                senders_data[sender]['name'] = decoded_name.strip()
-
-        return sorted(senders_data.items(), key=lambda x: x[1]['name'])
+    def load_senders(self, label=None, search=None):
+        # Sender names are decoded when they're stored, so they can be displayed as is
+        return sender_store.get_senders(label=label, search=search)
 
     def display_senders(self):
         for widget in self.scrollable_frame.winfo_children():
@@ -400,14 +376,7 @@ class SenderList(ctk.CTkFrame):
         self.is_filtered = True
         print(f"Filtering by label: {label}")
 
-        with open("src/data/sender_labels.json", "r") as file:
-            label_data = json.load(file)
-        
-        filtered_emails = label_data.get(label, [])
-        self.senders = [
-            (email, data) for email, data in self.load_senders()
-            if email in filtered_emails
-        ]
+        self.senders = self.load_senders(label=label)
 
         self.search_entry.delete(0, ctk.END)
         self.total_pages = (len(self.senders) + self.page_size - 1) // self.page_size
@@ -455,11 +424,7 @@ class SenderList(ctk.CTkFrame):
         else:
             print(f'searching for "{search_query}"...')
             self.toggle_searched(True)
-            self.senders = [
-                (email, data) for email, data in self.load_senders()
-                if search_query in email.lower()
-                or search_query in data['name'].lower()
-            ]
+            self.senders = self.load_senders(search=search_query)
         
         self.total_pages = (len(self.senders) + self.page_size - 1) // self.page_size
         self.current_page = 1
@@ -533,13 +498,19 @@ class SenderList(ctk.CTkFrame):
         self.scan_pbar.set(0)
         self.scan_pbar.pack(padx=(6, 12), pady=12, side="top", fill="x")
 
+        self.scan_results_label = ctk.CTkLabel(
+            master=self.scan_pframe,
+            text="",
+            font=("Switzer", 18),
+            justify="left",
+        ); self.scan_results_label.pack(padx=12, pady=(0, 12), side="top")
+
         self.scan_thread = threading.Thread(target=self.run_scan)
         self.scan_thread.start()
         self.after(100, self.check_scan_status)
 
     def run_scan(self):
-        scan_for_senders(self.scan_cancel_flag, self.update_scan_progress)
-        if not self.scan_cancel_flag.is_set():
+        if scan_for_senders(self.scan_cancel_flag, self.update_scan_progress, results_callback=self.update_scan_results):
             self.has_scanned = True
 
     def update_scan_progress(self, progress, n, total, rate, elapsed):
@@ -558,7 +529,15 @@ class SenderList(ctk.CTkFrame):
         time_remaining = f'{remaining_hours}:{remaining_minutes:02}:{remaining_seconds:02}'
 
         self.after(0, self.scan_pbar.set(progress))
-        self.scan_pbar_label_1.configure(text=f"{progress:.1%} | {time_elapsed} elapsed / {time_remaining} remaining | {rate*BATCH_SIZE:.2f} emails/s")
+        self.scan_pbar_label_1.configure(text=f"{progress:.1%} | {time_elapsed} elapsed / {time_remaining} remaining | {rate:.2f} emails/s")
+
+    def update_scan_results(self, senders):
+        # Called from the scan thread with a snapshot of the senders found so far
+        top_senders = sorted(senders.items(), key=lambda item: item[1]["frequency"], reverse=True)[:5]
+        text = f"{len(senders)} senders found so far"
+        if top_senders:
+            text += "\nTop senders: " + ", ".join(f"{address} ({info['frequency']})" for address, info in top_senders)
+        self.after(0, lambda: self.scan_results_label.winfo_exists() and self.scan_results_label.configure(text=text))
 
     def check_scan_status(self):
         if self.scan_thread is not None and self.scan_thread.is_alive():
@@ -572,15 +551,18 @@ class SenderList(ctk.CTkFrame):
                 self.cancel_scan_button.destroy()
                 self.scan_pbar.destroy()
                 self.scan_pbar_label_1.destroy()
+                self.scan_results_label.destroy()
                 self.scan_pframe.destroy()
                 self.scan_frame.destroy()
                 self.has_scanned_display()
             else: # scan cancelled
                 self.master.master.master.enable_sidebar_links()
+                if has_scan_checkpoint(): self.scan_button.configure(text="Resume Scan")
                 self.scan_button.pack(padx=12, pady=12, side="left")
                 self.cancel_scan_button.destroy()
                 self.scan_pbar.destroy()
                 self.scan_pbar_label_1.destroy()
+                self.scan_results_label.destroy()
                 self.scan_pframe.destroy()
 
     def cancel_scan(self):
@@ -591,89 +573,79 @@ class SenderList(ctk.CTkFrame):
     def add_label(self, address: str, label: str):
         print(f"NEW SENDER RULE CREATED > Email Address {address}'s emails will now be assigned label {label}")
 
-        with open("src/data/sender_labels.json", "r") as file:
-            data = json.load(file)
-        try: data[label].append(address)
-        except KeyError: data[label] = [address]
-        with open("src/data/sender_labels.json", "w") as file:
-            json.dump(data, file, indent=4)
+        sender_store.add_label(address, label)
         self.update_filter_dd()
 
     def update_filter_dd(self):
-        with open("src/data/sender_labels.json", "r") as file:
-            data = json.load(file)
-        self.filter_label_dd.configure(values=list(data.keys()))
+        self.filter_label_dd.configure(values=sender_store.FILTER_PLACEHOLDERS + sender_store.get_label_names())
 
     def unsubscribe(self, address: str):
         print(f"NEW SENDER RULE CREATED > Email Address {address}'s emails will now be auto-trashed")
 
-        if os.path.exists("src/data/unsubscribed.json"):
-            with open("src/data/unsubscribed.json", "r") as file:
-                data = json.load(file)
-            data[address] = True
-            with open("src/data/unsubscribed.json", "w") as file:
-                json.dump(data, file, indent=4)
-        else:
-            with open("src/data/unsubscribed.json", "w") as file:
-                json.dump({address: True}, file, indent=4)
+        sender_store.unsubscribe(address)
 
     def resubscribe(self, address: str):
         print(f"SENDER RULE UPDATED > Email Address {address}'s emails will no longer be auto-trashed")
 
-        if os.path.exists("src/data/unsubscribed.json"):
-            with open("src/data/unsubscribed.json", "r") as file:
-                data = json.load(file)
-            del data[address]
-            with open("src/data/unsubscribed.json", "w") as file:
-                json.dump(data, file, indent=4)
+        sender_store.resubscribe(address)
 
     def delete_sender(self, pbar:ctk.CTkProgressBar, address: str):
-        if self.delete_sender_thread is None or not self.delete_sender_thread.is_alive():
-            print(f"SenderList 'DELETE' > Deleting sender {address} from the list and trashing all of their emails...")
-            self.has_deleted_sender = False
+        # Senders deleted in quick succession are queued up and deleted together, over one connection
+        print(f"SenderList 'DELETE' > Queued sender {address} to be deleted from the list and have all of their emails trashed...")
+        self.delete_queue[address] = pbar
+        if not self.delete_batch and not self.delete_batch_scheduled:
+            self.delete_batch_scheduled = True
             self.master.master.master.disable_sidebar_links()
-            self.delete_sender_pbar = pbar
-            self.delete_sender_address = address
-            self.delete_sender_thread = threading.Thread(target=self.run_delete_sender, args=(address,))
-            self.delete_sender_thread.start()
-            self.after(100, self.check_delete_sender_status)
-        else:
-            print(f"SenderList 'DELETE' > A delete operation is already in progress")
+            self.after(DELETE_QUEUE_DELAY, self.start_delete_batch)
+
+    def start_delete_batch(self):
+        self.delete_batch_scheduled = False
+        self.delete_batch, self.delete_queue = self.delete_queue, {}
+        self.deleted_senders = None
+
+        print(f"SenderList 'DELETE' > Deleting {len(self.delete_batch)} senders from the list and trashing all of their emails...")
+        self.delete_sender_thread = threading.Thread(target=self.run_delete_senders, args=(list(self.delete_batch),))
+        self.delete_sender_thread.start()
+        self.after(100, self.check_delete_sender_status)
 
     def check_delete_sender_status(self):
         if self.delete_sender_thread is not None and self.delete_sender_thread.is_alive():
             self.after(100, self.check_delete_sender_status)
+            return
+
+        addresses = list(self.delete_batch)
+        if self.deleted_senders is not None:
+            for address in addresses:
+                print(f"SenderList 'DELETE' > Deleted sender {address} from the list and trashed all of their emails")
+                sender_store.delete_sender(address)
         else:
-            if self.has_deleted_sender:
-                print(f"SenderList 'DELETE' > Deleted sender {self.delete_sender_address} from the list and trashed all of their emails")
-                self.master.master.master.enable_sidebar_links()
-                self.refresh_sender_list(self.delete_sender_address)
-            else:
-                print(f"SenderList 'DELETE' > Failed to delete sender {self.delete_sender_address}")
-            self.delete_sender_thread = None
-            self.delete_sender_address = None
+            print(f"SenderList 'DELETE' > Failed to delete senders {', '.join(addresses)}")
+        self.delete_sender_thread = None
+        self.delete_batch = {}
+
+        # The list is only redisplayed once the queue is empty, since that recreates the queued senders' entries
+        if self.delete_queue:
+            self.start_delete_batch()
+        else:
+            self.master.master.master.enable_sidebar_links()
+            self.refresh_sender_list()
 
-    def run_delete_sender(self, address: str):
+    def run_delete_senders(self, addresses: list):
         try:
-            rm_from_sender(address, self.update_delete_sender_progress)
-            self.has_deleted_sender = True
+            self.deleted_senders = rm_from_senders(addresses, self.update_delete_sender_progress)
         except Exception as e:
-            print(f"Error deleting sender: {e}")
-            self.has_deleted_sender = False
+            print(f"Error deleting senders: {e}")
+            self.deleted_senders = None
 
-    def update_delete_sender_progress(self, progress):
-        self.after(0, lambda: self.delete_sender_pbar.set(progress))
-
-    def refresh_sender_list(self, address: str):
-        if os.path.exists("src/data/senders.json"):
-            with open("src/data/senders.json", "r") as file:
-                data = json.load(file)
-            
-            if address in data: del data[address]
+    def update_delete_sender_progress(self, address, progress):
+        self.after(0, lambda: self.set_delete_sender_progress(address, progress))
 
-            with open("src/data/senders.json", "w") as file:
-                json.dump(data, file, indent=4)
+    def set_delete_sender_progress(self, address, progress):
+        pbar = self.delete_batch.get(address)
+        if pbar is not None and pbar.winfo_exists():
+            pbar.set(progress)
 
+    def refresh_sender_list(self):
         self.senders = self.load_senders()
         self.sortedby = [None, None]
 
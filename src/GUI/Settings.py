@@ -2,7 +2,7 @@ import threading
 import customtkinter as ctk
 
 from src.GUI.AppStyles import *
-from src.reset_inbox import remove_ai_organizer_labels, remove_standard_organizer_labels, reset_sender_labels, reset_unsubscribed_senders, reset_categories, reset_sender_list
+from src.reset_inbox import remove_organizer_labels, reset_sender_labels, reset_unsubscribed_senders, reset_categories, reset_sender_list
 
 class Settings(ctk.CTkFrame):
     def __init__(self, master):
@@ -11,6 +11,11 @@ class Settings(ctk.CTkFrame):
             corner_radius=0,
             fg_color='transparent'
         )
+        self.reset_thread = None
+        self.reset_jobs = []
+        self.reset_succeeded = False
+        self.reset_progress = None  # latest (progress, current, total) reported by the reset thread
+
         self.init_json_reset_buttons()
         self.init_organizer_reset_buttons()
         self.pack(padx=12, pady=12, fill="both")
@@ -159,6 +164,10 @@ class Settings(ctk.CTkFrame):
             master=self,
             fg_color=Level2PageFrameFG
         )
+        self.reset_both_frame = ctk.CTkFrame(
+            master=self,
+            fg_color=Level2PageFrameFG
+        )
         self.reset_tip_frame = ctk.CTkScrollableFrame(
             master=self,
             fg_color=Level2PageFrameFG,
@@ -215,6 +224,26 @@ class Settings(ctk.CTkFrame):
             progress_color=DARK_RED
         ); self.reset_ai_organizer_frame.pack(padx=12, pady=12, fill="both")
 
+        self.reset_both_lbl = ctk.CTkLabel(
+            master=self.reset_both_frame,
+            text="Full Fresh Start:\nRemoves ALL labels assigned by both organizers, in a single pass over your inbox",
+            font=("Switzer Medium", 20),
+            wraplength=1000,
+            justify="left",
+            anchor="w",
+        ); self.reset_both_lbl.pack(padx=12, pady=12, fill="both")
+        self.reset_both_btn = ctk.CTkButton(
+            master=self.reset_both_frame,
+            text="Full Fresh Start",
+            font=("Switzer", 20, "bold"),
+            width=375,
+            height=50,
+            fg_color=DARK_RED,
+            hover_color=DARK_RED_HOVER,
+            command=self.reset_both_organizers,
+        ); self.reset_both_btn.pack(padx=12, pady=12, side="left")
+        self.reset_both_frame.pack(padx=12, pady=12, fill="both")
+
         self.reset_tip_label = ctk.CTkLabel(
             master=self.reset_tip_frame,
             text="** Important Note: For the \"Fresh Start\" options, It's much faster for you to just go into your Gmail inbox and manually remove the labels. " \
@@ -230,63 +259,69 @@ class Settings(ctk.CTkFrame):
         self.reset_tip_frame.pack(padx=12, pady=12, fill="both")
 
     def reset_organizer(self):
-        print("Settings > Performing Email Organizer Fresh Start...")
-        self.master.master.master.disable_sidebar_links()
-        self.reset_organizer_btn.configure(state="disabled", fg_color=DARK_RED_HOVER, text="Resetting...")
-        self.reset_organizer_pbar.set(0)
-        self.reset_organizer_pbar.pack(padx=12, pady=(12.5, 12.5), side="left")
-
-        self.reset_thread = threading.Thread(target=self.run_reset_organizer)
-        self.reset_thread.start()
-        self.after(100, self.check_reset_organizer_status)
+        self.start_reset(standard=True, ai=False)
 
     def reset_ai_organizer(self):
-        print("Settings > Performing AI Organizer Fresh Start...")
+        self.start_reset(standard=False, ai=True)
+
+    def reset_both_organizers(self):
+        self.start_reset(standard=True, ai=True)
+
+    def start_reset(self, standard, ai):
+        if self.reset_thread is not None and self.reset_thread.is_alive():
+            print("Settings > A Fresh Start is already in progress")
+            return
+
+        self.reset_jobs = []
+        if standard: self.reset_jobs.append((self.reset_organizer_btn, self.reset_organizer_pbar, "Email Organizer Fresh Start"))
+        if ai: self.reset_jobs.append((self.reset_ai_organizer_btn, self.reset_ai_organizer_pbar, "AI Organizer Fresh Start"))
+        print(f"Settings > Performing {' and '.join(text for _, _, text in self.reset_jobs)}...")
+
         self.master.master.master.disable_sidebar_links()
-        self.reset_ai_organizer_btn.configure(state="disabled", fg_color=DARK_RED_HOVER, text="Resetting...")
-        self.reset_ai_organizer_pbar.set(0)
-        self.reset_ai_organizer_pbar.pack(padx=12, pady=(12.5, 12.5), side="left")
+        for btn in (self.reset_organizer_btn, self.reset_ai_organizer_btn, self.reset_both_btn):
+            btn.configure(state="disabled")
+        for btn, pbar, _ in self.reset_jobs:
+            btn.configure(fg_color=DARK_RED_HOVER, text="Resetting...")
+            pbar.set(0)
+            pbar.pack(padx=12, pady=(12.5, 12.5), side="left")
 
-        self.reset_ai_thread = threading.Thread(target=self.run_reset_ai_organizer)
-        self.reset_ai_thread.start()
-        self.after(100, self.check_reset_ai_organizer_status)
+        self.reset_succeeded = False
+        self.reset_progress = None
+        self.reset_thread = threading.Thread(target=self.run_reset, args=(standard, ai))
+        self.reset_thread.start()
+        self.after(100, self.check_reset_status)
 
-    def run_reset_organizer(self):
-        remove_standard_organizer_labels(self.update_reset_organizer_pbar)
+    def run_reset(self, standard, ai):
+        try:
+            remove_organizer_labels(standard, ai, self.update_reset_pbars)
+            self.reset_succeeded = True
+        except Exception as e:
+            print(f"Settings > Error during Fresh Start: {e}")
 
-    def run_reset_ai_organizer(self):
-        remove_ai_organizer_labels(self.update_reset_ai_organizer_pbar)
+    def update_reset_pbars(self, progress, current, total, rate, elapsed):
+        # Called from the reset thread, so only the latest progress is kept here, and
+        # check_reset_status() shows it from the GUI thread
+        self.reset_progress = (progress, current, total)
 
-    def update_reset_organizer_pbar(self, progress, current, total, rate, elapsed):
-        self.reset_organizer_pbar.set(progress)
-        self.reset_organizer_btn.configure(text=f"Resetting... {current}/{total}")
-        self.update()
+    def show_reset_progress(self, progress, current, total):
+        for btn, pbar, _ in self.reset_jobs:
+            pbar.set(progress)
+            btn.configure(text=f"Resetting... {current}/{total}")
+
+    def check_reset_status(self):
+        reset_progress = self.reset_progress
+        if reset_progress is not None:
+            self.show_reset_progress(*reset_progress)
 
-    def update_reset_ai_organizer_pbar(self, progress, current, total, rate, elapsed):
-        self.reset_ai_organizer_pbar.set(progress)
-        self.reset_ai_organizer_btn.configure(text=f"Resetting... {current}/{total}")
-        self.update()
-    
-    def check_reset_organizer_status(self):
         if self.reset_thread is not None and self.reset_thread.is_alive():
-            self.after(100, self.check_reset_organizer_status)
-        else:
-            self.master.master.master.enable_sidebar_links()
-            self.reset_organizer_pbar.pack_forget()
-            self.update()
-            self.reset_organizer_btn.configure(state="normal", text="Success!")
-            self.update()
-            self.after(500, self.reset_organizer_btn.configure(text="Email Organizer Fresh Start", fg_color=DARK_RED))
-            print("Settings > Email Organizer Fresh Start Complete!")
+            self.after(100, self.check_reset_status)
+            return
 
-    def check_reset_ai_organizer_status(self):
-        if self.reset_ai_thread is not None and self.reset_ai_thread.is_alive():
-            self.after(100, self.check_reset_ai_organizer_status)
-        else:
-            self.master.master.master.enable_sidebar_links()
-            self.reset_ai_organizer_pbar.pack_forget()
-            self.update()
-            self.reset_ai_organizer_btn.configure(state="normal", text="Success!")
-            self.update()
-            self.after(500, self.reset_ai_organizer_btn.configure(text="AI Organizer Fresh Start", fg_color=DARK_RED))
-            print("Settings > AI Organizer Fresh Start Complete!")
+        self.master.master.master.enable_sidebar_links()
+        for btn in (self.reset_organizer_btn, self.reset_ai_organizer_btn, self.reset_both_btn):
+            btn.configure(state="normal")
+        for btn, pbar, text in self.reset_jobs:
+            pbar.pack_forget()
+            btn.configure(text="Success!" if self.reset_succeeded else "Failed")
+            self.after(500, lambda btn=btn, text=text: btn.configure(text=text, fg_color=DARK_RED))
+        print(f"Settings > Fresh Start {'Complete!' if self.reset_succeeded else 'Failed'}")
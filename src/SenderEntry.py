@@ -6,11 +6,11 @@ Author: Michael Camerato
 Date: 8/3/24
 """
 
-import json
-import os
 import threading
 import customtkinter as ctk
 from .GUI.AppStyles import *
+from .rule_engine import domain_rule
+from .sender_store import is_unsubscribed
 
 class SenderEntry:
     def __init__(self, email_address, name, frequency, add_label_callback,
@@ -35,6 +35,7 @@ class SenderEntry:
 
         self.add_label_button = None
         self.add_label_entry = None
+        self.add_label_domain_checkbox = None
         self.add_label_confirm_button = None
 
         self.rm_sender_thread = None
@@ -182,6 +183,14 @@ class SenderEntry:
             text=f"Add a label to all emails from {self.address}:",
             font=("Switzer Medium", 16),
         )
+        # Labels every sender at the address's domain instead (a "@example.com" rule, see rule_engine.py)
+        self.add_label_domain_checkbox = ctk.CTkCheckBox(
+            self.sender_txt_frame,
+            text=f"Label every sender at {domain_rule(self.address)}",
+            font=("Switzer Medium", 16),
+            fg_color=DARK_BLUE,
+            hover_color=DARK_BLUE_HOVER
+        )
         self.add_label_confirm_button = ctk.CTkButton(
             self.sender_txt_frame,
             width=200,
@@ -213,6 +222,7 @@ class SenderEntry:
 
             self.add_label_label.pack_forget()
             self.add_label_entry.pack_forget()
+            self.add_label_domain_checkbox.pack_forget()
             self.add_label_confirm_button.pack_forget()
 
             self.email_address_label.pack(anchor="w", padx=12, pady=(12, 0))
@@ -240,6 +250,7 @@ class SenderEntry:
 
             self.add_label_label.pack(anchor="w", padx=12, pady=(12, 0))
             self.add_label_entry.pack(anchor="w", padx=12, pady=(6, 0))
+            self.add_label_domain_checkbox.pack(anchor="w", padx=12, pady=(6, 0))
             self.add_label_confirm_button.pack(anchor="w", padx=12, pady=(6, 12))
 
             self.sender_frame.update()
@@ -248,8 +259,10 @@ class SenderEntry:
         label = self.add_label_entry.get().strip()
 
         if label:
+            rule = domain_rule(self.address) if self.add_label_domain_checkbox.get() else self.address
             self.add_label_entry.delete(0, 'end')
-            self.add_label_callback(self.address, label)
+            self.add_label_domain_checkbox.deselect()
+            self.add_label_callback(rule, label)
             self.add_label()
 
     def unsubscribe(self):
@@ -329,12 +342,8 @@ class SenderEntry:
             print(f"SenderEntry 'DELETE' > A delete operation is already in progress for sender {self.address}")
 
     def init_sub_button(self):
-        if os.path.exists("src/data/unsubscribed.json"):
-            with open("src/data/unsubscribed.json", "r") as file:
-                data = json.load(file)
-            if self.address in data: self.unsubscribed = True
-            else: self.unsubscribed = False
-            self.update_sub_button()
+        self.unsubscribed = is_unsubscribed(self.address)
+        self.update_sub_button()
 
     def update_sub_button(self):
         if self.unsubscribed:
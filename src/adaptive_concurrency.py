@@ -0,0 +1,267 @@
+"""
+This file contains the adaptive concurrency controller shared by the sender scan, the organizers,
+sender deletion and the inbox reset.
+
+Instead of fixed connection counts and batch sizes, each operation asks its controller how many
+connections to use and how many emails to put in each IMAP command. The controller follows an
+AIMD (additive increase, multiplicative decrease) policy: while throughput keeps improving it adds
+one connection and grows the batch size a step at a time, and as soon as Gmail throttles us
+([THROTTLED], BYE) or a command takes far longer than the latency it has learned for that kind and
+size of command (a fixed cost per command plus a cost per email), it halves both and backs off.
+"""
+
+import imaplib
+import threading
+import time
+
+THROTTLE_MARKERS = (b"THROTTLED", b"UNAVAILABLE", b"OVERQUOTA", b"Too many simultaneous connections")
+
+LATENCY_TOLERANCE = 2.0     # a command taking this many times its predicted latency counts as congestion
+LATENCY_DECAY = 0.95        # weight a command's latency keeps in the latency model after each newer command
+MIN_JUDGED_ITEMS = 10       # commands covering fewer emails than this are never judged as congestion
+MIN_MODEL_SAMPLES = 5       # commands of a kind to see before judging congestion from their latency
+IMPROVEMENT_THRESHOLD = 1.05  # a window's throughput must beat the last one by 5% to keep growing
+MAX_BACKOFF = 60            # seconds
+
+def is_throttled(result):
+    """
+    Checks whether the (result, data) tuple returned by an imaplib command is a throttling response,
+    e.g. ('NO', [b'[THROTTLED] ...']).
+    """
+    if not isinstance(result, tuple) or len(result) != 2 or result[0] == "OK":
+        return False
+    text = b" ".join(item for item in result[1] or [] if isinstance(item, bytes))
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+def is_throttle_error(error):
+    """
+    Checks whether an exception raised by imaplib means the server is throttling us.
+    A BYE from the server (imaplib.IMAP4.abort) is treated as throttling.
+    """
+    if isinstance(error, imaplib.IMAP4.abort):
+        return True
+    return any(marker in str(error).encode(errors="ignore") for marker in THROTTLE_MARKERS)
+
+class LatencyModel:
+    """
+    Predicts how long a kind of command (e.g. a UID FETCH) takes for a given number of emails, as a fixed
+    cost per command plus a cost per email, fitted to the latencies of recent uncongested commands.
+
+    Dividing a command's latency by its email count would make every small command (the last chunk of a
+    run, a rule that matched 3 emails) look far slower per email than a full batch, since most of its
+    latency is the round trip.
+    """
+    def __init__(self):
+        self.samples = 0
+        # Decayed sums for a least squares fit of latency = fixed + per_item * items
+        self._weight = self._x = self._y = self._xx = self._xy = 0.0
+
+    def add(self, items, latency):
+        self.samples += 1
+        self._weight = self._weight * LATENCY_DECAY + 1
+        self._x = self._x * LATENCY_DECAY + items
+        self._y = self._y * LATENCY_DECAY + latency
+        self._xx = self._xx * LATENCY_DECAY + items * items
+        self._xy = self._xy * LATENCY_DECAY + items * latency
+
+    def fit(self):
+        """
+        @return: tuple containing the fixed cost per command and the cost per email, in seconds
+                 (the cost per email is None when the recent commands were all about the same size)
+        """
+        mean_x, mean_y = self._x / self._weight, self._y / self._weight
+        variance = self._xx / self._weight - mean_x * mean_x
+        if variance <= (0.1 * mean_x) ** 2:
+            return mean_y, None
+        per_item = max((self._xy / self._weight - mean_x * mean_y) / variance, 0.0)
+        return max(mean_y - per_item * mean_x, 0.0), per_item
+
+    def predict(self, items):
+        """
+        @return: predicted latency of a command covering this many emails, or None if there's too little data
+        """
+        if self.samples < MIN_MODEL_SAMPLES:
+            return None
+        fixed, per_item = self.fit()
+        if per_item is None:
+            # Only one command size has been seen, so assume larger commands cost proportionally more
+            mean_x = self._x / self._weight
+            return fixed * max(1.0, items / max(mean_x, 1.0))
+        return fixed + per_item * items
+
+class AdaptiveController:
+    def __init__(self, name, workers=4, min_workers=1, max_workers=16,
+      batch_size=500, min_batch_size=50, max_batch_size=5000, batch_step=250):
+        self.name = name
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+
+        self._workers = workers
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+
+        self._models = {}
+        self._backoff = 0
+        self._generation = 0
+        self._last_rate = None
+        self._reset_window()
+
+    @property
+    def workers(self):
+        """
+        @return: how many connections the operation should currently be using
+        """
+        return self._workers
+
+    @property
+    def batch_size(self):
+        """
+        @return: how many emails the operation should currently put in each command
+        """
+        return self._batch_size
+
+    @property
+    def generation(self):
+        """
+        @return: how many times the controller has backed off. A command passes the generation it
+                 started in when it's recorded, so the commands that were already in flight when
+                 the controller backed off don't make it back off again for the same congestion.
+        """
+        return self._generation
+
+    @property
+    def item_latency(self):
+        """
+        @return: the per-email cost of the most common kind of command, in seconds, or None until it's known
+        """
+        with self._lock:
+            models = sorted(self._models.values(), key=lambda model: model.samples, reverse=True)
+            return models[0].fit()[1] if models and models[0].samples >= MIN_MODEL_SAMPLES else None
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_items = 0
+        self._window_results = 0
+
+    def _increase(self):
+        self._workers = min(self.max_workers, self._workers + 1)
+        self._batch_size = min(self.max_batch_size, self._batch_size + self.batch_step)
+
+    def _decrease(self, reason):
+        self._generation += 1
+        self._workers = max(self.min_workers, self._workers // 2)
+        self._batch_size = max(self.min_batch_size, self._batch_size // 2)
+        self._last_rate = None
+        self._reset_window()
+        print(f"{self.name} > {reason}, backing off to {self._workers} connections / {self._batch_size} emails per command")
+
+    def record_success(self, items, latency, kind=None, generation=None):
+        """
+        Records a command that succeeded.
+
+        @param items: number of emails the command covered
+        @param latency: seconds the command took
+        @param kind: kind of command (e.g. "FETCH"), since each kind has its own latency model
+        @param generation: the controller's generation when the command was sent (optional, see generation)
+        """
+        with self._lock:
+            self._backoff = 0
+            model = self._models.setdefault(kind, LatencyModel())
+            stale = generation is not None and generation != self._generation
+
+            if items >= MIN_JUDGED_ITEMS:
+                predicted = model.predict(items)
+                if predicted is not None and latency > predicted * LATENCY_TOLERANCE:
+                    if not stale:
+                        self._decrease("Latency rising")
+                    return
+            # Only uncongested commands go into the model, so it keeps describing a healthy connection
+            model.add(items, latency)
+
+            # A command sent before the last backoff doesn't say anything about the current settings
+            if stale:
+                return
+
+            self._window_items += items
+            self._window_results += 1
+
+            # One window is roughly one round of commands across every connection
+            if self._window_results >= self._workers:
+                rate = self._window_items / max(time.monotonic() - self._window_start, 1e-6)
+                if self._last_rate is None or rate >= self._last_rate * IMPROVEMENT_THRESHOLD:
+                    self._increase()
+                self._last_rate = rate
+                self._reset_window()
+
+    def record_throttle(self, generation=None):
+        """
+        Records a throttling response from the server.
+
+        @param generation: the controller's generation when the command was sent (optional, see generation)
+
+        @return: how many seconds to wait before trying again
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # The controller has already backed off for this congestion
+                return max(1, self._backoff)
+            self._decrease("Throttled by the server")
+            self._backoff = min(MAX_BACKOFF, max(1, self._backoff * 2))
+            return self._backoff
+
+    def call(self, command, *args, items=1, attempts=5):
+        """
+        Runs an imaplib command, retrying with backoff while the server is throttling us.
+
+            result, data = controller.call(mail.uid, "STORE", uid_set, "+X-GM-LABELS", label, items=n)
+
+        @param command: imaplib method to call
+        @param items: number of emails the command covers
+        @param attempts: how many times to try the command before giving up
+
+        @return: the (result, data) tuple from the last attempt
+        @raise imaplib.IMAP4.abort: if the server drops the connection (e.g. with a BYE), after backing
+                                    off, since the command can't be retried until the caller reconnects
+        """
+        for attempt in range(attempts):
+            generation = self._generation
+            start = time.monotonic()
+            try:
+                result = command(*args)
+            except (imaplib.IMAP4.error, OSError) as e:
+                if is_throttle_error(e):
+                    time.sleep(self.record_throttle(generation))
+                raise
+            if not is_throttled(result):
+                self.record_success(items, time.monotonic() - start, command_kind(command, args), generation)
+                return result
+            if attempt < attempts - 1:
+                time.sleep(self.record_throttle(generation))
+        return result
+
+def command_kind(command, args):
+    """
+    @return: name of the kind of command being sent, e.g. "uid FETCH" for controller.call(mail.uid, "FETCH", ...)
+    """
+    name = getattr(command, "__name__", str(command))
+    if args and isinstance(args[0], str):
+        return f"{name} {args[0].upper()}"
+    return name
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(name, **settings):
+    """
+    Returns the process-wide controller for an operation, so that what it learned about the
+    connection carries over between runs. The settings are only used when it's first created.
+
+    @param name: name of the operation, e.g. "Sender Scan"
+    """
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = AdaptiveController(name, **settings)
+        return _controllers[name]
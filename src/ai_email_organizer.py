@@ -18,13 +18,28 @@ import re
 import json
 import os
 import html
+import sys
+import threading
 from openai import OpenAI
 from bs4 import BeautifulSoup
 
+from .gmail_labels import fetch_labels
+from .imap_connection import borrow_connection, select_mailbox
+from .mailbox_sync import commit_sync, search_changed, start_sync
+from .uid_sets import chunk_uids, compress_uids, parse_search_response
+
 MODEL = "gpt-4o-mini"
 TARGET_MAILBOX = '"[Gmail]/All Mail"'
 CATEGORIES_FILE = "src/data/data.json"
+PROMPT_TEMPLATE_FILE = "src/data/gpt4o_prompt_template.txt"
 AI_ORGANIZE_OPERATION_RESULT = "ERROR"
+SYNC_JOB = "ai_organizer"
+
+LOG_FILE = "src/data/log.jsonl"
+COMPACT_LOG_FILE = "src/data/log.json"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # size at which the log is rotated
+LOG_BACKUPS = 5                   # rotated logs that are kept
+_log_lock = threading.Lock()
 
 # -------------------------------------------------------------------------------------------------------------------
 # This variable is VERY IMPORTANT. It is the cut-off point for the email body length.
@@ -46,46 +61,17 @@ def save_categories():
 
 CATEGORIES = load_categories()
 
-def establish_connection():
-    """
-    Establishes a connection to the gmail server using the credentials in the config.ini file.
-
-    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
-    """
-
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    email_address = config["gmail"]["email"]
-    password = config["gmail"]["password"]
-
-    for attempt in range(3):
-        try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            break
-        except Exception as e:
-            if attempt < 2:
-                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
-            else:
-                raise Exception(f"Failed to connect to imap.gmail.com after {attempt+1} attempts: {e}")
-    mail.login(email_address, password)
-    mail.login(email_address, password)
-
-    print("AI Email Organizer > Connection established to Gmail server")
-    return mail
-
-def fetch_uids(mail:imaplib.IMAP4_SSL, num_emails):
+def fetch_uids(mail:imaplib.IMAP4_SSL, num_emails, delta):
     """
     Fetches a list of email UIDs from the target mailbox.
+    Only emails that changed since the AI organizer last checked every email are searched.
 
     @param num_emails: the number of emails to fetch
+    @param delta: MailboxDelta for the target mailbox, from start_sync()
     @return: a list of email UIDs cut off at the specified number of emails
     """
 
-    mail.select(TARGET_MAILBOX)
-    _, data = mail.uid("SEARCH", None, '(NOT X-GM-LABELS "Email Organizer/AI Organizer/AI Checked Emails")')
-
-    all_uids = data[0].split()
+    all_uids = search_changed(mail, delta, '(NOT X-GM-LABELS "Email Organizer/AI Organizer/AI Checked Emails")')
     if num_emails == "all":
         uids = all_uids
     else:
@@ -95,20 +81,92 @@ def fetch_uids(mail:imaplib.IMAP4_SSL, num_emails):
     )
     return uids
 
+def rotate_log():
+    """
+    Renames log.jsonl to log.jsonl.1 (and log.jsonl.1 to log.jsonl.2, etc.),
+    deleting the oldest log once there are LOG_BACKUPS of them.
+    """
+    for n in range(LOG_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{LOG_FILE}.{n}"):
+            os.replace(f"{LOG_FILE}.{n}", f"{LOG_FILE}.{n + 1}")
+    os.replace(LOG_FILE, f"{LOG_FILE}.1")
+
 def log_to_file(uid, json_data):
-    LOG_FILE = "src/data/log.json"
-    uid = uid.decode("utf-8")
-    log_entry = {f"{uid}": json_data}
+    """
+    Appends an entry for an email to the log, as a single line of JSON.
+    The log is rotated once it grows past LOG_MAX_BYTES.
+    """
+    uid = str(uid)
+    line = json.dumps({"uid": uid, "data": json_data}) + "\n"
 
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "r") as file:
-            data = json.load(file)
-    else: data = {}
-    
-    data.update(log_entry)
+    with _log_lock:
+        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) >= LOG_MAX_BYTES:
+            rotate_log()
+        with open(LOG_FILE, "a") as file:
+            file.write(line)
 
-    with open(LOG_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+def compact_log():
+    """
+    Builds the keyed view of the log in log.json, which maps each email's UID to its latest entry,
+    from the current log and its rotated backups. It reads every log, so it's only built when asked for:
+
+        python -m src.ai_email_organizer --compact-log
+
+    @return: dict containing the keyed view
+    """
+    data = {}
+    with _log_lock:
+        log_files = [f"{LOG_FILE}.{n}" for n in range(LOG_BACKUPS, 0, -1)] + [LOG_FILE]
+        for log_file in log_files:
+            if not os.path.exists(log_file): continue
+            with open(log_file, "r") as file:
+                for line in file:
+                    try: entry = json.loads(line)
+                    except json.JSONDecodeError: continue  # a line cut short by a crash
+                    data[entry["uid"]] = entry["data"]
+
+        with open(COMPACT_LOG_FILE, "w") as file:
+            json.dump(data, file, indent=4)
+    return data
+
+class CompiledPrompt:
+    """
+    The prompt template, parsed once per run. The system message and the part of the user message before
+    the email (the instructions and the category list) are the same for every email, so every request
+    starts with the same prefix, which the API's prompt caching can reuse. Only the email itself changes.
+    """
+    def __init__(self, system_content, prefix, suffix):
+        self.system_content = system_content
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def messages(self, email_content):
+        """
+        @param email_content: the email's summary, from get_email_summary()
+
+        @return: list of messages for client.chat.completions.create()
+        """
+        return [
+            {"role": "system", "content": self.system_content},
+            {"role": "user", "content": self.prefix + email_content + self.suffix},
+        ]
+
+def compile_prompt(categories):
+    """
+    Reads the prompt template and fills in everything but the email.
+
+    The template file holds the system message, then "PROMPT_TEMPLATE", then the user message,
+    which contains a {categories} and an {email_content} placeholder.
+
+    @param categories: list of the user's categories
+
+    @return: CompiledPrompt
+    """
+    with open(PROMPT_TEMPLATE_FILE, 'r') as file:
+        content = file.read()
+    system_content, prompt_template = content.split("PROMPT_TEMPLATE")
+    prefix, _, suffix = prompt_template.strip().partition("{email_content}")
+    return CompiledPrompt(system_content.strip(), prefix.format(categories=categories), suffix.format(categories=categories))
 
 def setup_openai_api():
     """
@@ -166,23 +224,27 @@ def get_email_summary(email_msg):
 
     return message
 
-def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag):
+def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag, prompt=None):
     """
     Uses Generative AI to organize the UIDs of the fetched emails
     into categories specified by the user. As each email's category is
     generated, the email is assigned to the corresponding label.
 
     @param uids: list of email uids to organize
+    @param prompt: CompiledPrompt to use (optional, the prompt template is compiled with the current categories by default)
 
     @return boolean indicating whether the emails were successfully organized
     """
     global AI_ORGANIZE_OPERATION_RESULT
 
+    prompt = prompt or compile_prompt(CATEGORIES)
+
     successful_moves = 0
     unreadable_emails = 0
     skipped_emails = 0
 
-    mail.select(TARGET_MAILBOX)
+    select_mailbox(mail, TARGET_MAILBOX)
+    labels = fetch_labels(mail, uids)
 
     for uid in uids:
         if ai_organizer_flag.is_set():
@@ -191,7 +253,7 @@ def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag):
             return False
 
         try:
-            _, data = mail.uid("FETCH", uid.decode(), "(RFC822)")
+            _, data = mail.uid("FETCH", str(uid), "(RFC822)")
             if not data or not data[0]:
                 raise Exception(f"FETCH ERROR")
             
@@ -200,22 +262,12 @@ def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag):
             email_content = get_email_summary(email_msg)
             print('\n------------------------------------------------------------------')
             
-            def load_gpt4o_prompt():
-                with open("src/data/gpt4o_prompt_template.txt", 'r') as file:
-                    content = file.read()
-                system_content, prompt_template = content.split("PROMPT_TEMPLATE")
-                system_content = system_content.strip(); prompt_template = prompt_template.strip()
-                gpt4o_prompt = prompt_template.format(categories=CATEGORIES, email_content=email_content)
-                return system_content, gpt4o_prompt
-
-            gpt4o_system_content, gpt4o_prompt = load_gpt4o_prompt()
-            
+            messages = prompt.messages(email_content)
+            gpt4o_prompt = messages[-1]["content"]
+
             completion = client.chat.completions.create(
                 model=MODEL,
-                messages=[
-                    {"role": "system", "content": gpt4o_system_content},
-                    {"role": "user", "content": gpt4o_prompt},
-                ]
+                messages=messages
             )
 
             response = completion.choices[0].message.content
@@ -231,18 +283,18 @@ def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag):
             }
 
             if response in CATEGORIES:
-                add_label(mail, uid, response, log_data)
+                add_label(mail, uid, response, log_data, labels.get(int(uid)))
                 successful_moves += 1
             elif response == "NONE":
-                print(f"AI Email Organizer > Email with UID {uid.decode('utf-8')} is either unreadable or doesn't fall into any of the user-defined categories. Assigned label 'Unsure'.")
-                add_label(mail, uid, "Unsure", log_data)
+                print(f"AI Email Organizer > Email with UID {uid} is either unreadable or doesn't fall into any of the user-defined categories. Assigned label 'Unsure'.")
+                add_label(mail, uid, "Unsure", log_data, labels.get(int(uid)))
                 unreadable_emails += 1
             else:
                 print(f"AI Email Organizer > Error: Response '{response}' not found in list of categories.")
 
         except Exception as e:
             if e == "FETCH ERROR":
-                fetch_error = f"Error fetching email with UID {uid.decode('utf-8')}. Server Resposne Code {_}, Server Response: {data}"
+                fetch_error = f"Error fetching email with UID {uid}. Server Resposne Code {_}, Server Response: {data}"
                 print(f"AI Email Organizer > Fetch Error: {fetch_error}")
                 log_data = {"fetch_error": fetch_error}
                 log_to_file(uid, log_data)
@@ -260,34 +312,31 @@ def organize_emails(mail:imaplib.IMAP4_SSL, uids, client, ai_organizer_flag):
     return True
 
 def get_labels(mail, uid):
-    _, data = mail.uid("FETCH", uid, "(X-GM-LABELS)")
-    raw_string = data[0].decode("utf-8")
-    match = re.search(r'\(X-GM-LABELS \((.*?)\) UID \d+\)', raw_string)
-    labels = re.findall(r'"([^"]+)"', match.group(1))
-    for label in labels:
-        if label.startswith("\\"):
-            label = label[2:]
-    return labels
-
-def add_label(mail:imaplib.IMAP4_SSL, uid, label_name, log_data):
+    """
+    @return: sorted list of the labels of the email with the given UID
+    """
+    return sorted(fetch_labels(mail, [uid]).get(int(uid), ()))
+
+def add_label(mail:imaplib.IMAP4_SSL, uid, label_name, log_data, labels=None):
     """
     Adds the generated label to an email to categorize it.
 
     @param uid: the uid of the email to add the label to
     @param label_name: the name of the label to assign the email to
+    @param labels: the email's existing labels, from fetch_labels() (optional, they're fetched if not given)
 
     @return: boolean indicating whether the UID was successfully labeled
     """
 
-    mail.select(TARGET_MAILBOX)
+    select_mailbox(mail, TARGET_MAILBOX)
 
-    # Fetch the existing labels for the email
-    labels = get_labels(mail, uid)
-    print(f"\nAI Email Organizer > Existing labels for email with UID {uid.decode('utf-8')}: {labels}")
+    # Fetch the existing labels for the email, unless they were already fetched with the rest of the run's emails
+    labels = get_labels(mail, uid) if labels is None else sorted(labels)
+    print(f"\nAI Email Organizer > Existing labels for email with UID {uid}: {labels}")
     log_data["existing_labels"] = labels
 
     # Add the label to the email 
-    result, data = mail.uid("STORE", uid, "+X-GM-LABELS", f'"Email Organizer/AI Organizer/{label_name}"')
+    result, data = mail.uid("STORE", str(uid), "+X-GM-LABELS", f'"Email Organizer/AI Organizer/{label_name}"')
     add_pred_label = {
         "call": f"mail.uid('STORE', {uid}, '+X-GM-LABELS', 'Email Organizer/AI Organizer/{label_name}')",
         "result": result,
@@ -297,10 +346,10 @@ def add_label(mail:imaplib.IMAP4_SSL, uid, label_name, log_data):
     # If the label was added successfuly...
     if result == "OK":
 
-        print(f"AI Email Organizer > Email with UID {uid.decode('utf-8')} successfuly assigned label '{label_name}'!")
+        print(f"AI Email Organizer > Email with UID {uid} successfuly assigned label '{label_name}'!")
 
         # Add the checked label to the email
-        result, data = mail.uid("STORE", uid, "+X-GM-LABELS", '"Email Organizer/AI Organizer/AI Checked Emails"')
+        result, data = mail.uid("STORE", str(uid), "+X-GM-LABELS", '"Email Organizer/AI Organizer/AI Checked Emails"')
         add_checked_label = {
             "call": f"mail.uid('STORE', {uid}, '+X-GM-LABELS', '\"Email Organizer/AI Organizer/AI Checked Emails\"')",
             "result": result,
@@ -309,32 +358,59 @@ def add_label(mail:imaplib.IMAP4_SSL, uid, label_name, log_data):
 
         # If the checked label was added successfully...
         if result == "OK":            
-            print(f"AI Email Organizer > Email with UID {uid.decode('utf-8')} successfuly marked as checked!")
+            print(f"AI Email Organizer > Email with UID {uid} successfuly marked as checked!")
             return True
         
         # If the checked label was not added successfully...
         else:
-            print(f"AI Email Organizer > Error adding label 'Checked' to email with UID {uid.decode('utf-8')}.\
+            print(f"AI Email Organizer > Error adding label 'Checked' to email with UID {uid}.\
             \tServer result: {result}\tServer response: {data}")
             log_to_file(uid, log_data)
             return False
     
     # If the label was not added successfully...
     else:
-        print(f"AI Email Organizer > Error adding label '{label_name}' to email with UID {uid.decode('utf-8')}.\
+        print(f"AI Email Organizer > Error adding label '{label_name}' to email with UID {uid}.\
         \tServer result: {result}\tServer response: {data}")
         log_to_file(uid, log_data)
         return False
 
-def ai_email_organizer(ai_organizer_flag, num_emails):
+def all_checked(mail:imaplib.IMAP4_SSL, uids):
+    """
+    Checks whether every one of the given emails has been marked as checked by the AI organizer.
+
+    @param uids: list of email uids
+    @return: boolean indicating whether none of the emails are still unchecked
+    """
+    select_mailbox(mail, TARGET_MAILBOX)
+    for chunk in chunk_uids(uids):
+        _, data = mail.uid("SEARCH", None, f'(UID {compress_uids(chunk)} NOT X-GM-LABELS "Email Organizer/AI Organizer/AI Checked Emails")')
+        if parse_search_response(data): return False
+    return True
+
+def ai_email_organizer(ai_organizer_flag, num_emails, full_sync=False, compact=False):
     """
     Main function for the AI Email Organizer.
+
+    @param compact: True to rebuild the keyed view of the log (see compact_log()) once the run is over
     """
 
     client = setup_openai_api()
-    mail = establish_connection()
-    uids = fetch_uids(mail, num_emails)
-    ai_organizer_flag.set() if not organize_emails(mail, uids, client, ai_organizer_flag) else ai_organizer_flag.clear()
-    mail.expunge()
-    mail.logout()
+    with borrow_connection() as mail:
+        delta = start_sync(mail, TARGET_MAILBOX, SYNC_JOB, full_sync)
+        uids = fetch_uids(mail, num_emails, delta)
+        ai_organizer_flag.set() if not organize_emails(mail, uids, client, ai_organizer_flag) else ai_organizer_flag.clear()
+        mail.expunge()
+
+        # Emails that weren't checked this time (skipped, errors, or beyond num_emails) must
+        # still be found by the next run, so the checkpoint only moves once everything is checked.
+        if num_emails == "all" and not ai_organizer_flag.is_set() and all_checked(mail, uids):
+            commit_sync(delta)
+
+    if compact:
+        compact_log()
     return AI_ORGANIZE_OPERATION_RESULT
+
+if __name__ == "__main__":
+    if "--compact-log" in sys.argv[1:]:
+        print(f"AI Email Organizer > {len(compact_log())} emails written to {COMPACT_LOG_FILE}")
@@ -5,85 +5,49 @@ Author: Michael Camerato
 Date: 8/13/2024
 """
 
-import configparser
-import imaplib
-import json
-import os
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import tqdm
 
-TARGET_MAILBOX = '"[Gmail]/All Mail"'
-SENDER_LABELS_FILE = "src/data/sender_labels.json"
-UNSUBSCRIBED_FILE = "src/data/unsubscribed.json"
-
-EMAIL_REGEX = re.compile(r'<\s*(.*?)\s*>')
-BRACKETS_REGEX = re.compile(r'<\s*(.*?)\s*>')
-
-def establish_connection():
-    """
-    Establishes a connection to the gmail server using the credentials in the config.ini file.
-
-    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
-    """
+from . import sender_store
+from .adaptive_concurrency import get_controller
+from .header_parser import parse_from_header
+from .imap_connection import borrow_connection, check_response, select_mailbox
+from .mailbox_sync import commit_sync, search_changed, start_sync
+from .rule_engine import compile_rules
+from .uid_sets import chunk_uids, compress_uids, parse_fetch_literals, parse_search_response, sort_uids
 
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    email_address = config["gmail"]["email"]
-    password = config["gmail"]["password"]
-
-    for attempt in range(3):
-        try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            break
-        except Exception as e:
-            if attempt < 2:
-                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
-            else:
-                raise Exception(f"Failed to connect to imap.gmail.com after {attempt+1} attempts: {e}")
-    mail.login(email_address, password)
+TARGET_MAILBOX = '"[Gmail]/All Mail"'
+SYNC_JOB = "standard_organizer"
+CHECKED_LABEL = '"Email Organizer/Standard Organizer/Checked Emails"'
 
-    print("Standard Email Organizer > Connection established to Gmail server")
-    return mail
+# "server" applies each rule with a Gmail search, "fetch" reads the sender of every email
+ORGANIZE_MODE = "server"
+RULE_SEARCH_SIZE = 50  # most sender addresses combined into one X-GM-RAW search
+MAX_SHARDS = 8         # most connections a run is split over
+MIN_SHARD_SIZE = 1000  # fewest emails worth giving their own connection
 
 def get_sender_rules():
     """
-    Fetches the sender rules from the corresponding JSON files.
+    Fetches the sender rules from the sender store and compiles them.
 
-    @return: dict containing each sender that has been assigned a rule.
+    @return: RuleEngine containing every sender rule (see rule_engine.py)
     """
-    rules = {}
-    
-    if os.path.exists(SENDER_LABELS_FILE):
-        with open(SENDER_LABELS_FILE, "r") as file:
-            sender_labels = json.load(file)
-            sender_labels = {k: v for k, v in sender_labels.items() if k not in ["Filter by Label", "---"]}
-    
-    if os.path.exists(UNSUBSCRIBED_FILE):
-        with open(UNSUBSCRIBED_FILE, "r") as file:
-            unsubscribed = json.load(file)
-
-    for label in sender_labels.keys():
-        for address in sender_labels[label]:
-            rules[address] = label
-    
-    for address in unsubscribed:
-        rules[address] = "Unsubscribed"
-    
-    return rules
+    return compile_rules(sender_store.get_sender_rules())
 
-def fetch_uids(mail):
+def fetch_uids(mail, delta):
     """
     Fetches a list of email UIDs from the target mailbox that have not been checked.
+    Only emails that changed since the organizer's last completed run are searched.
 
-    @return: a list of email UIDs cut off at the specified number of emails
-    """
-
-    mail.select(TARGET_MAILBOX)
+    @param delta: MailboxDelta for the target mailbox, from start_sync()
 
-    _, data = mail.search(None, '(NOT X-GM-LABELS "Email Organizer/Standard Organizer/Checked Emails")')
+    @return: a list of email UIDs
+    """
 
-    uids = data[0].split()
+    uids = search_changed(mail, delta, '(NOT X-GM-LABELS "Email Organizer/Standard Organizer/Checked Emails")')
     print(
         f"Standard Email Organizer > {len(uids)} emails were fetched from the target mailbox"
     )
@@ -91,76 +55,397 @@ def fetch_uids(mail):
 
 def get_sender(raw_sender):
     """
-    Extracts the sender's email address from an email object.
+    Extracts the sender's email address from an email's From header.
 
-    @param raw_sender: raw sender string
+    @param raw_sender: raw From header, as bytes or str
 
     @return: email address
     """
-    match = BRACKETS_REGEX.search(raw_sender)
-    if match:
-        return match.group(1)
+    return parse_from_header(raw_sender)[1]
 
-    else: # bruh
-        if(raw_sender.startswith("From: ")):
-            raw_sender = f"<{raw_sender[6:]}>"
-            return get_sender(raw_sender)
 
+def get_actions(data, rules):
+    """
+    Works out what to do with each email in a batch from its From header.
+
+    @param data: data returned by a UID FETCH of the batch's From headers
+    @param rules: RuleEngine containing the sender rules
 
+    @return: dict mapping each rule's label (or "Unsubscribed") to the list of email UIDs it applies to.
+             Emails without a rule are listed under None.
+    """
+    uids_by_action = {}
+    for uid, raw_header in parse_fetch_literals(data):
+        if uid is None: continue
+        uids_by_action.setdefault(rules.match(get_sender(raw_header)), []).append(uid)
+    return uids_by_action
 
-def process_email(mail, uid, rules):
+def fetch_headers(mail, uids, controller):
     """
-    Processes an email with the given UID.
+    Fetches the From headers of a batch of emails.
 
-    @param mail: imaplib.IMAP4_SSL object representing the connection to the gmail server
-    @param uid: email UID to process
-    @param rules: dictionary containing the sender rules
+    @return: data returned by the UID FETCH (or FETCHes, if the batch's UID set is too long for one command)
+    @raise imaplib.IMAP4.error: if a FETCH fails, rather than leaving its emails out of the batch
     """
-    
-    _, data = mail.uid("FETCH", uid.decode(), "(BODY[HEADER.FIELDS (FROM)])")
-    if not data or not data[0]: return
-    email_address = get_sender(data[0][1].decode())
-    
-    mail.uid("STORE", uid, "+X-GM-LABELS", '"Email Organizer/Standard Organizer/Checked Emails"')
-    
-    if(email_address in rules):
-        if rules[email_address] == "Unsubscribed":
-            mail.uid("STORE", uid, "+X-GM-LABELS", "\\Trash")
-            print(f"Standard Email Organizer > Email from unsubscribed address '{email_address}' was trashed.")
-        else:
-            mail.uid("STORE", uid, "+X-GM-LABELS", f'"Email Organizer/Standard Organizer/{rules[email_address]}"')
-            print(f"Standard Email Organizer > Email from labelled address '{email_address}' was assigned the '{rules[email_address]}' label.")
+    data = []
+    for chunk in chunk_uids(uids):
+        response = controller.call(mail.uid, "FETCH", compress_uids(chunk), "(UID BODY.PEEK[HEADER.FIELDS (FROM)])", items=len(chunk))
+        data += check_response(response, "UID FETCH")
+    return data
 
 def organize_emails(mail, uids, rules, cancel_flag=None, progress_callback=None):
     """
-    Organizes the emails in the target mailbox based on the rules defined in the Sender List page.
+    Organizes the emails in the target mailbox based on the rules defined in the Sender List page,
+    by reading the sender of every email.
+
+    The From headers are fetched a batch at a time, the batch's emails are grouped by the rule that
+    applies to them, and each group is labelled (or trashed) and marked as checked with a single UID STORE.
 
     @param uids: list of email UIDs to organize
+    @param rules: RuleEngine containing the sender rules
     @param cancel_flag: threading.Event object to cancel the organization process (optional)
     @param progress_callback: function to call with the progress of the organization process (optional)
+
+    @return: True if every email was organized, False if the process was cancelled
+    @raise imaplib.IMAP4.error: if the server rejects one of the commands
     """
-    counter = 0
-    total_emails = len(uids)
-    with tqdm.tqdm(total=total_emails, desc="Organizing emails...") as pbar:
-        for uid in uids:
+    controller = get_controller("Standard Email Organizer")
+    uids = sort_uids(uids)
+    position = 0
+
+    with tqdm.tqdm(total=len(uids), desc="Organizing emails...") as pbar:
+        while position < len(uids):
             if cancel_flag and cancel_flag.is_set():
                 print("\nOrganizing cancelled...\n")
-                return
-            
-            process_email(mail, uid, rules)
-            counter += 1
+                return False
+
+            batch = uids[position:position + controller.batch_size]
+            position += len(batch)
+            for action, action_uids in get_actions(fetch_headers(mail, batch, controller), rules).items():
+                labels = get_rule_labels(action) if action else CHECKED_LABEL
+                for chunk in chunk_uids(action_uids):
+                    response = controller.call(mail.uid, "STORE", compress_uids(chunk), "+X-GM-LABELS", labels, items=len(chunk))
+                    check_response(response, "UID STORE")
+                if action:
+                    print(f"Standard Email Organizer > {len(action_uids)} emails were {describe_action(action)}.")
+
+            pbar.update(len(batch))
             if progress_callback:
-                progress_callback(counter / total_emails, pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+                progress_callback(pbar.format_dict['n'] / len(uids), pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
 
-            pbar.update(1)
+    print("Standard Email Organizer > All emails were organized")
+    return True
+
+def get_rule_labels(action):
+    """
+    @param action: a sender rule's label, or "Unsubscribed"
+
+    @return: the X-GM-LABELS to add to an email matching the rule, including the checked label
+    """
+    if action == "Unsubscribed":
+        return f"({CHECKED_LABEL} \\Trash)"
+    return f'({CHECKED_LABEL} "Email Organizer/Standard Organizer/{action}")'
+
+def describe_action(action):
+    return "trashed" if action == "Unsubscribed" else f"assigned the '{action}' label"
+
+def search_rule(mail, senders, uid_range="1:*"):
+    """
+    Finds the unchecked emails sent by any of the given senders with a single Gmail search.
+
+    Non-ASCII addresses can't be sent in a quoted string, so a search containing any is sent as a
+    UTF-8 literal with CHARSET UTF-8 instead.
+
+    @param senders: list of sender email addresses or domains
+    @param uid_range: only search the emails in this range of UIDs, e.g. "100:200"
+
+    @return: list of email UIDs
+    """
+    if all(sender.isascii() for sender in senders):
+        query = " OR ".join(sender.replace("\\", "\\\\").replace('"', '\\"') for sender in senders)
+        response = mail.uid("SEARCH", None, f'(UID {uid_range} X-GM-RAW "from:({query})" NOT X-GM-LABELS {CHECKED_LABEL})')
+    else:
+        # imaplib sends the literal after the last argument, so X-GM-RAW has to come last
+        mail.literal = f'from:({" OR ".join(senders)})'.encode("utf-8")
+        response = mail.uid("SEARCH", "CHARSET", "UTF-8", f"UID {uid_range} NOT X-GM-LABELS {CHECKED_LABEL} X-GM-RAW")
+    # A failed search must not look like one that found nothing, or the rule's emails would only be marked as checked
+    return parse_search_response(check_response(response, "UID SEARCH"))
+
+def search_rule_matches(mail, uids, rules, cancel_flag=None):
+    """
+    Runs the rule searches of a server mode run (see organize_emails_on_server()).
+
+    The addresses of each exact address rule are combined into X-GM-RAW "from:(a OR b OR ...)" searches.
+    Gmail's matching isn't precise enough for domain and pattern rules, so the emails a domain rule
+    could apply to are only narrowed down with a search of the domain (if there are pattern rules,
+    every email that no exact address rule applies to is a candidate).
+
+    @param uids: list of email UIDs to organize
+    @param rules: RuleEngine containing the sender rules
+    @param cancel_flag: threading.Event object to cancel the organization process (optional)
+
+    @return: tuple containing a dict mapping each exact address rule's action to the list of email UIDs
+             it applies to, and the set of candidate email UIDs whose senders have to be read.
+             None if the process was cancelled.
+    @raise imaplib.IMAP4.error: if the server rejects one of the searches
+    """
+    pending = set(int(uid) for uid in uids)
+    uid_range = f"{min(pending)}:{max(pending)}"
+
+    addresses_by_action = {}
+    for address, action in rules.exact.items():
+        addresses_by_action.setdefault(action, []).append(address)
+
+    # Exact address rules are the most specific, so they're applied first.
+    # Each email has a single sender, so it matches at most one of them.
+    uids_by_action = {}
+    for action, addresses in addresses_by_action.items():
+        for i in range(0, len(addresses), RULE_SEARCH_SIZE):
+            if cancel_flag and cancel_flag.is_set():
+                return None
+            matched = [uid for uid in search_rule(mail, addresses[i:i + RULE_SEARCH_SIZE], uid_range) if uid in pending]
+            uids_by_action.setdefault(action, []).extend(matched)
+            pending.difference_update(matched)
+
+    if rules.patterns:
+        return uids_by_action, pending
+
+    candidates = set()
+    domains = rules.searchable_domains()
+    for i in range(0, len(domains), RULE_SEARCH_SIZE):
+        if cancel_flag and cancel_flag.is_set():
+            return None
+        candidates.update(uid for uid in search_rule(mail, domains[i:i + RULE_SEARCH_SIZE], uid_range) if uid in pending)
+    return uids_by_action, candidates
+
+def apply_rule_matches(mail, uids, rules, cancel_flag=None, progress_callback=None, matches=None):
+    """
+    Organizes the emails of a server mode run once the rule searches are done: the senders of the
+    candidate emails are read and matched by the rule engine, then the emails found are labelled
+    (or trashed) and marked as checked with one UID STORE per chunk of emails. Finally, every email
+    that didn't match a rule is marked as checked in bulk.
 
+    Only the given emails are organized, so the searches of a sharded run can be shared by every shard.
+
+    @param uids: list of email UIDs to organize
+    @param matches: the results of search_rule_matches(), for these emails or for any emails including them
+
+    @return: True if every email was organized, False if the process was cancelled
+    @raise imaplib.IMAP4.error: if the server rejects one of the commands
+    """
+    controller = get_controller("Standard Email Organizer")
+    pending = set(int(uid) for uid in uids)
+    matched_by_action, candidates = matches
+
+    uids_by_action = {}
+    for action, action_uids in matched_by_action.items():
+        uids_by_action[action] = [uid for uid in action_uids if uid in pending]
+        pending.difference_update(uids_by_action[action])
+    candidates = [uid for uid in candidates if uid in pending]
+
+    for chunk in chunk_uids(candidates, controller.batch_size):
+        if cancel_flag and cancel_flag.is_set():
+            print("\nOrganizing cancelled...\n")
+            return False
+        for action, action_uids in get_actions(fetch_headers(mail, chunk, controller), rules).items():
+            if action is None: continue
+            uids_by_action.setdefault(action, []).extend(action_uids)
+            pending.difference_update(action_uids)
+
+    stores = [(get_rule_labels(action), action_uids) for action, action_uids in uids_by_action.items()]
+    stores.append((CHECKED_LABEL, pending))
+
+    with tqdm.tqdm(total=len(uids), desc="Organizing emails...") as pbar:
+        for labels, action_uids in stores:
+            for chunk in chunk_uids(action_uids, controller.batch_size):
+                if cancel_flag and cancel_flag.is_set():
+                    print("\nOrganizing cancelled...\n")
+                    return False
+
+                response = controller.call(mail.uid, "STORE", compress_uids(chunk), "+X-GM-LABELS", labels, items=len(chunk))
+                check_response(response, "UID STORE")
+                pbar.update(len(chunk))
+                if progress_callback:
+                    progress_callback(pbar.format_dict['n'] / len(uids), pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+
+    for action, action_uids in uids_by_action.items():
+        if action_uids:
+            print(f"Standard Email Organizer > {len(action_uids)} emails were {describe_action(action)}.")
     print("Standard Email Organizer > All emails were organized")
+    return True
+
+def organize_emails_on_server(mail, uids, rules, cancel_flag=None, progress_callback=None):
+    """
+    Organizes the emails in the target mailbox by letting Gmail find the emails each rule applies to,
+    instead of reading the sender of every email: the rules are searched for with
+    search_rule_matches(), then applied with apply_rule_matches().
+
+    @param uids: list of email UIDs to organize
+    @param rules: RuleEngine containing the sender rules
+    @param cancel_flag: threading.Event object to cancel the organization process (optional)
+    @param progress_callback: function to call with the progress of the organization process (optional)
+
+    @return: True if every email was organized, False if the process was cancelled
+    @raise imaplib.IMAP4.error: if the server rejects one of the commands
+    """
+    matches = search_rule_matches(mail, uids, rules, cancel_flag)
+    if matches is None:
+        print("\nOrganizing cancelled...\n")
+        return False
+    return apply_rule_matches(mail, uids, rules, cancel_flag, progress_callback, matches)
+
+class ShardProgress:
+    """
+    Merges the progress reported by each shard of a sharded run into a single progress stream,
+    reported with the usual (progress, n, total, rate, elapsed) signature.
+    """
+    def __init__(self, total, progress_callback):
+        self.total = total
+        self.progress_callback = progress_callback
+        self.done = {}
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def for_shard(self, shard):
+        def shard_progress(progress, n, total, rate, elapsed):
+            with self.lock:
+                self.done[shard] = n
+                n = sum(self.done.values())
+                elapsed = time.monotonic() - self.start
+                self.progress_callback(n / self.total, n, self.total, n / max(elapsed, 1e-6), elapsed)
+        return shard_progress if self.progress_callback else None
+
+class AnyFlag:
+    """
+    Looks like a threading.Event to the shards, and is set as soon as any of the given flags is set.
+    """
+    def __init__(self, *flags):
+        self.flags = [flag for flag in flags if flag is not None]
+
+    def is_set(self):
+        return any(flag.is_set() for flag in self.flags)
+
+def organize_shard(organize, uids, rules, cancel_flag, progress_callback, failed=None):
+    """
+    Organizes one shard on its own connection. If it fails, the failed flag (optional) is set
+    straight away, so the other shards stop instead of running to the end first.
+    """
+    try:
+        with borrow_connection() as mail:
+            select_mailbox(mail, TARGET_MAILBOX)
+            return organize(mail, uids, rules, cancel_flag, progress_callback)
+    except BaseException:
+        if failed is not None:
+            failed.set()
+        raise
+
+def organize_emails_sharded(organize, uids, rules, shards, cancel_flag=None, progress_callback=None):
+    """
+    Splits the emails into contiguous ranges of UIDs and organizes each range (shard) on its own
+    connection, in parallel. The shards share the cancel flag, and their progress is merged.
+
+    @param organize: organize_emails or organize_emails_on_server
+    @param uids: list of email UIDs to organize
+    @param rules: RuleEngine containing the sender rules
+    @param shards: number of shards (and connections) to use
+
+    @return: True if every email was organized, False if the process was cancelled
+    """
+    if organize is organize_emails_on_server:
+        # Each search covers the whole run's range of UIDs anyway, so the searches are run once for
+        # every shard, and only the header fetches and STOREs are split across the connections
+        with borrow_connection() as mail:
+            select_mailbox(mail, TARGET_MAILBOX)
+            matches = search_rule_matches(mail, uids, rules, cancel_flag)
+        if matches is None:
+            print("\nOrganizing cancelled...\n")
+            return False
+        organize = partial(apply_rule_matches, matches=matches)
+
+    uids = sort_uids(uids)
+    size = -(-len(uids) // shards)
+    ranges = [uids[i:i + size] for i in range(0, len(uids), size)]
+    print(f"Standard Email Organizer > Organizing {len(uids)} emails over {len(ranges)} connections")
+
+    merged_progress = ShardProgress(len(uids), progress_callback)
+    failed = threading.Event()  # stops the other shards when one of them fails
+    shard_cancel_flag = AnyFlag(cancel_flag, failed)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(organize_shard, organize, shard_uids, rules, shard_cancel_flag, merged_progress.for_shard(shard), failed)
+            for shard, shard_uids in enumerate(ranges)
+        ]
+        results = []
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except BaseException:
+                failed.set()
+                raise
+        return all(results)
+
+def all_checked(mail, uids):
+    """
+    Checks whether every one of the given emails has been marked as checked by the standard organizer.
+
+    @param uids: list of email UIDs
+    @return: boolean indicating whether none of the emails are still unchecked
+    """
+    select_mailbox(mail, TARGET_MAILBOX)
+    for chunk in chunk_uids(uids):
+        response = mail.uid("SEARCH", None, f"(UID {compress_uids(chunk)} NOT X-GM-LABELS {CHECKED_LABEL})")
+        if parse_search_response(check_response(response, "UID SEARCH")): return False
+    return True
+
+def get_shard_count(num_emails, shards=None):
+    """
+    Decides how many connections to organize a run over.
+
+    @param num_emails: number of emails in the run
+    @param shards: number of connections asked for (optional, decided by the adaptive controller otherwise)
+
+    @return: number of shards, at least 1, and never so many that a shard has fewer than MIN_SHARD_SIZE emails
+    """
+    if shards is None:
+        shards = min(get_controller("Standard Email Organizer").workers, MAX_SHARDS)
+    return max(1, min(shards, num_emails // MIN_SHARD_SIZE))
+
+def email_organizer(cancel_flag=None, progress_callback=None, full_sync=False, mode=ORGANIZE_MODE, shards=None):
+    """
+    Main function for the Standard Email Organizer.
 
-def email_organizer(cancel_flag=None, progress_callback=None):
+    @param cancel_flag: threading.Event object to cancel the organization process (optional)
+    @param progress_callback: function to call with the progress of the organization process (optional)
+    @param full_sync: True to search the whole mailbox instead of only the emails changed since the last run
+    @param mode: "server" or "fetch" (see ORGANIZE_MODE)
+    @param shards: number of connections to organize the emails over in parallel. By default, this is
+                   decided by the organizer's adaptive controller, for runs of at least MIN_SHARD_SIZE emails.
+    """
     rules = get_sender_rules()
-    mail = establish_connection()
-    uids = fetch_uids(mail)
-    organize_emails(mail, uids, rules, cancel_flag, progress_callback)
+    organize = organize_emails_on_server if mode == "server" else organize_emails
+    with borrow_connection() as mail:
+        delta = start_sync(mail, TARGET_MAILBOX, SYNC_JOB, full_sync)
+        uids = fetch_uids(mail, delta)
+
+    shards = get_shard_count(len(uids), shards)
+    if uids and shards > 1:
+        organized = organize_emails_sharded(organize, uids, rules, shards, cancel_flag, progress_callback)
+    elif uids:
+        organized = organize_shard(organize, uids, rules, cancel_flag, progress_callback)
+    else:
+        organized = True
+
+    # Emails left unchecked must still be found by the next run, so the checkpoint only moves once every one is checked
+    if organized and not (cancel_flag and cancel_flag.is_set()):
+        if not uids:
+            commit_sync(delta)
+            return
+        with borrow_connection() as mail:
+            if all_checked(mail, uids):
+                commit_sync(delta)
+            else:
+                print("Standard Email Organizer > Some emails weren't marked as checked, they'll be organized by the next run")
 
 if __name__ == "__main__":
     email_organizer()
@@ -0,0 +1,144 @@
+"""
+This file contains the label inventory: bulk fetching of Gmail's X-GM-LABELS for many emails at once,
+and the parsers for the responses that carry label names (FETCH and LIST).
+
+A FETCH of X-GM-LABELS for a range of UIDs comes back as one response per email, e.g.
+
+    * 12 FETCH (X-GM-LABELS ("\\Inbox" Work "Email Organizer/AI Organizer/Receipts") UID 345)
+
+where each label may be an atom, a quoted string with backslash escapes, or a literal ({n} followed by
+n bytes, which imaplib hands over as a separate item). The whole response is read with a single
+streaming tokenizer, rather than with a regex per email, into a mapping of UID -> set of labels.
+
+Label names are kept exactly as the server sends them (non-ASCII names are in modified UTF-7), so they
+can be passed back to STORE and SEARCH as they are.
+"""
+
+import re
+
+from .uid_sets import chunk_uids, compress_uids
+
+# One token of a response: "(", ")", a quoted string, a literal's {n} marker, or an atom
+TOKEN_REGEX = re.compile(r'(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\s*$|([^\s()"]+)')
+QUOTED_PAIR_REGEX = re.compile(r'\\(.)')
+
+OPEN = object()
+CLOSE = object()
+
+def quote_label(label):
+    """
+    @return: the label as an IMAP quoted string, e.g. '"Email Organizer/AI Organizer/Work"'
+    """
+    return '"' + label.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _decode(value):
+    return value.decode("utf-8", errors="replace")
+
+def tokenize(data):
+    """
+    Splits the data returned by imaplib for a command into tokens, in a single pass.
+
+    @param data: list of bytes lines and (prefix, literal) tuples, as returned by imaplib
+
+    @return: generator of OPEN, CLOSE, or str tokens (atoms, unquoted strings and literals)
+    """
+    for item in data or []:
+        text, literal = item if isinstance(item, tuple) else (item, None)
+        if not text:
+            continue
+
+        for opened, closed, quoted, literal_size, atom in TOKEN_REGEX.findall(_decode(text)):
+            if opened:
+                yield OPEN
+            elif closed:
+                yield CLOSE
+            elif atom:
+                yield atom
+            elif literal_size:
+                yield _decode(literal) if literal is not None else f"{{{literal_size}}}"
+            else:
+                yield QUOTED_PAIR_REGEX.sub(r'\1', quoted) if "\\" in quoted else quoted
+
+def parse_responses(data):
+    """
+    Parses the parenthesized lists of a response into nested Python lists, e.g. the response
+    '12 (X-GM-LABELS ("a" b) UID 345)' gives ['X-GM-LABELS', ['a', 'b'], 'UID', '345'].
+    Anything outside of the parentheses (like the sequence number) is skipped.
+
+    @return: generator of one list per top-level parenthesized list (one per email, for a FETCH)
+    """
+    stack = []
+    for token in tokenize(data):
+        if token is OPEN:
+            stack.append([])
+        elif token is CLOSE:
+            if not stack:
+                continue
+            finished = stack.pop()
+            if stack:
+                stack[-1].append(finished)
+            else:
+                yield finished
+        elif stack:
+            stack[-1].append(token)
+
+def parse_label_fetch(data):
+    """
+    Parses the response to a FETCH of (UID X-GM-LABELS) for any number of emails.
+
+    @param data: data returned by mail.uid("FETCH", ..., "(UID X-GM-LABELS)")
+
+    @return: dict mapping each UID (int) to its set of labels
+    """
+    inventory = {}
+    for response in parse_responses(data):
+        items = dict(zip((str(key).upper() for key in response[::2]), response[1::2]))
+        uid = items.get("UID")
+        if isinstance(uid, str) and uid.isdigit():
+            labels = items.get("X-GM-LABELS")
+            inventory[int(uid)] = set(labels) if isinstance(labels, list) else set()
+    return inventory
+
+def fetch_labels(mail, uids, controller=None):
+    """
+    Fetches the labels of many emails, with one UID FETCH per chunk of UIDs (a single one for a range).
+
+    @param uids: list of email UIDs, or a UID set string such as "1:*"
+    @param controller: AdaptiveController to send the commands through (optional). A range's
+                       email count isn't known, so a range is fetched without it.
+
+    @return: dict mapping each UID (int) to its set of labels
+    """
+    if isinstance(uids, str):
+        _, data = mail.uid("FETCH", uids, "(UID X-GM-LABELS)")
+        return parse_label_fetch(data)
+
+    inventory = {}
+    for chunk in chunk_uids(uids):
+        if controller:
+            _, data = controller.call(mail.uid, "FETCH", compress_uids(chunk), "(UID X-GM-LABELS)", items=len(chunk))
+        else:
+            _, data = mail.uid("FETCH", compress_uids(chunk), "(UID X-GM-LABELS)")
+        inventory.update(parse_label_fetch(data))
+    return inventory
+
+def parse_list_response(data):
+    """
+    Parses the mailbox names out of the response to a LIST command. Gmail lists every label as a mailbox.
+
+    @param data: data returned by mail.list(), e.g. [b'(\\HasNoChildren) "/" "Email Organizer/AI Organizer/Work"']
+
+    @return: list of mailbox names, leaving out the ones that can't be selected (\\Noselect)
+    """
+    names = []
+    for item in data or []:
+        tokens = list(tokenize([item]))
+        # (flags) delimiter name
+        if len(tokens) < 2 or tokens[0] is not OPEN or CLOSE not in tokens:
+            continue
+        close = tokens.index(CLOSE)
+        flags, rest = tokens[1:close], tokens[close + 1:]
+        if len(rest) < 2 or any(flag.lower() == "\\noselect" for flag in flags):
+            continue
+        names.append(rest[1])
+    return names
@@ -0,0 +1,139 @@
+"""
+This file contains a small, fast parser for the From header, used by the sender scan for every email
+it reads and by the standard organizer.
+
+Building a full email.message.Message for a header that's a single line long costs far more than the
+header itself, so the header is unfolded, split into name and address, and its RFC 2047 encoded words
+(e.g. "=?UTF-8?B?...?=") are decoded in one pass over the string. The decoded name is what gets stored
+in the sender list, so nothing has to decode it again when the list is loaded.
+"""
+
+import base64
+import binascii
+import re
+
+# An encoded word: =?charset?encoding?text?=, where the charset may carry a language (charset*lang)
+ENCODED_WORD_REGEX = re.compile(r'=\?([^?*]+)(?:\*[^?]*)?\?([bBqQ])\?([^?]*)\?=')
+# Whitespace between two adjacent encoded words is not part of the text
+ENCODED_WORD_GAP_REGEX = re.compile(r'(\?=)\s+(=\?)')
+Q_ESCAPE_REGEX = re.compile(rb'=([0-9A-Fa-f]{2})')
+FOLDING_REGEX = re.compile(r'\r?\n[ \t]+')
+HEADER_NAME_REGEX = re.compile(r'^\s*From\s*:', re.IGNORECASE)
+QUOTED_PAIR_REGEX = re.compile(r'\\(.)')
+
+def _decode_q(text):
+    return Q_ESCAPE_REGEX.sub(lambda match: bytes([int(match.group(1), 16)]), text.replace("_", " ").encode("latin-1", errors="replace"))
+
+def _decode_b(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def _decode_bytes(raw, charset):
+    try:
+        return raw.decode(charset, errors="replace")
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")
+
+def decode_encoded_words(text):
+    """
+    Decodes the RFC 2047 encoded words in a header value, leaving the rest of it as is.
+
+    Adjacent encoded words in the same charset are decoded together, like email.header.decode_header()
+    does, since a multi-byte character (e.g. in Chinese or Japanese) may be split across two of them.
+
+    @param text: header value, e.g. "=?UTF-8?Q?Caf=C3=A9?= Newsletter"
+
+    @return: decoded string, e.g. "Café Newsletter"
+    """
+    if "=?" not in text:
+        return text
+    text = ENCODED_WORD_GAP_REGEX.sub(r'\1\2', text)
+
+    parts = []
+    charset, raw = None, b""  # the run of adjacent encoded words not decoded yet
+    position = 0
+    for match in ENCODED_WORD_REGEX.finditer(text):
+        word_charset, encoding, encoded = match.groups()
+        try:
+            word = _decode_b(encoded) if encoding in "bB" else _decode_q(encoded)
+        except (binascii.Error, ValueError):
+            continue  # left in the text as is
+
+        if match.start() != position or word_charset.lower() != charset:
+            if raw:
+                parts.append(_decode_bytes(raw, charset))
+            parts.append(text[position:match.start()])
+            charset, raw = word_charset.lower(), b""
+        raw += word
+        position = match.end()
+
+    if raw:
+        parts.append(_decode_bytes(raw, charset))
+    parts.append(text[position:])
+    return "".join(parts)
+
+def _first_mailbox(value):
+    """
+    @return: the first mailbox of an address list, e.g. 'John <john@x.com>' for 'John <john@x.com>, Jane <jane@x.com>'
+    """
+    quoted = escaped = False
+    depth = 0  # inside <...> or (...)
+    for i, char in enumerate(value):
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char in "<(":
+            depth += 1
+        elif char in ">)":
+            depth = max(depth - 1, 0)
+        elif char == "," and depth == 0:
+            return value[:i].strip()
+    return value
+
+def _unquote(name):
+    name = name.strip()
+    if len(name) >= 2 and name[0] == '"' and name[-1] == '"':
+        name = QUOTED_PAIR_REGEX.sub(r'\1', name[1:-1])
+    return name.strip()
+
+def parse_from_header(raw_header):
+    """
+    Extracts the sender's name and email address from a raw From header.
+
+    Handles headers folded over several lines, names in quotes or in a trailing comment
+    ("a@b.com (Name)"), and encoded words in the name. When the header lists several
+    addresses, only the first one is used.
+
+    @param raw_header: the header as returned by a BODY[HEADER.FIELDS (FROM)] fetch, as bytes or str.
+                       The "From:" prefix is optional.
+
+    @return: tuple containing the sender's decoded name and email address ("" for either if missing)
+    """
+    if isinstance(raw_header, bytes):
+        raw_header = raw_header.decode("utf-8", errors="replace")
+
+    value = FOLDING_REGEX.sub(" ", raw_header).strip()
+    match = HEADER_NAME_REGEX.match(value)
+    if match:
+        value = value[match.end():]
+    # A fetch of the header fields ends with a blank line, and a duplicated From header starts a new line
+    value = _first_mailbox(value.split("\n", 1)[0].strip())
+    if not value:
+        return "", ""
+
+    start = value.rfind("<")
+    end = value.find(">", start + 1)
+    if start != -1 and end != -1:
+        address = value[start + 1:end].strip()
+        name = value[:start]
+    else:
+        address, _, comment = value.partition(" ")
+        name = comment.strip()
+        if name.startswith("(") and name.endswith(")"):
+            name = name[1:-1]
+
+    return decode_encoded_words(_unquote(name)), address.strip()
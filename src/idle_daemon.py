@@ -0,0 +1,183 @@
+"""
+This file contains the IDLE daemon, a long-running headless process that organizes new emails as they arrive,
+instead of waiting for the Email Organizer page's button to be clicked.
+
+The daemon keeps a dedicated connection in IMAP IDLE on the target mailbox. When the server reports new
+emails, it leaves IDLE, finds the UIDs that arrived since the last ones it saw with a single UID SEARCH, and
+applies the sender rules to only those emails (and, optionally, the AI organizer) on a pooled connection.
+It then goes back to IDLE. If the connection drops, it reconnects with an increasing delay and catches
+up on whatever arrived in the meantime.
+
+On startup (and whenever the mailbox's UIDVALIDITY changes), one regular run of the standard organizer
+catches up on the emails that arrived while the daemon wasn't running.
+
+    python -m src.idle_daemon          organize new emails with the sender rules
+    python -m src.idle_daemon --ai     also organize them with the AI organizer
+"""
+
+import imaplib
+import re
+import select
+import ssl
+import sys
+import threading
+import time
+
+from . import ai_email_organizer
+from .email_organizer import TARGET_MAILBOX, email_organizer, get_sender_rules, organize_emails
+from .imap_connection import borrow_connection, close_connection, open_connection, select_mailbox
+from .uid_sets import parse_search_response
+
+# Servers may end an IDLE after 30 minutes of silence, so it's restarted a little before that
+IDLE_REFRESH = 25 * 60
+POLL_INTERVAL = 1         # seconds between checks of the stop flag while idling
+MAX_RECONNECT_DELAY = 300
+
+EXISTS_REGEX = re.compile(rb'^\* \d+ EXISTS')
+
+def has_unread_response(mail):
+    """
+    Checks whether data from the server has already been received but not read yet. Data that's
+    sitting in imaplib's buffered file (or that the TLS layer has already decrypted) doesn't make
+    the socket readable, so select() alone would wait on it until the next response arrives.
+    """
+    timeout = mail.sock.gettimeout()
+    # Without blocking, peek() only returns what's already buffered, or what's ready to be read
+    mail.sock.settimeout(0)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+class IdleDaemon:
+    def __init__(self, stop_flag=None, use_ai=False):
+        """
+        @param stop_flag: threading.Event object that stops the daemon when set (optional)
+        @param use_ai: True to also organize new emails with the AI organizer
+        """
+        self.stop_flag = stop_flag or threading.Event()
+        self.use_ai = use_ai
+        self.client = ai_email_organizer.setup_openai_api() if use_ai else None
+        self.uidvalidity = None
+        self.last_uid = None  # highest UID that has been organized
+
+    def connect(self):
+        """
+        Opens the daemon's IDLE connection and selects the target mailbox. If the daemon hasn't seen this
+        mailbox before (or its UIDs were reset), the standard organizer catches up on it first.
+
+        @return: imaplib.IMAP4_SSL object representing the IDLE connection
+        """
+        mail = open_connection()
+        mail.select(TARGET_MAILBOX)
+        uidvalidity = int(mail.response("UIDVALIDITY")[1][-1])
+        uidnext = int(mail.response("UIDNEXT")[1][-1])
+
+        if uidvalidity != self.uidvalidity:
+            print("IDLE Daemon > Catching up on the target mailbox...")
+            email_organizer(self.stop_flag)
+            self.uidvalidity = uidvalidity
+            self.last_uid = uidnext - 1
+        return mail
+
+    def idle(self, mail):
+        """
+        Puts the connection in IDLE until the server reports new emails, the IDLE needs to be
+        refreshed, or the daemon is stopped, and then ends the IDLE.
+
+        @return: True if the server reported new emails
+        """
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        response = mail.readline()
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {response.decode(errors='replace').strip()}")
+
+        new_mail = False
+        started = time.monotonic()
+        while not new_mail and not self.stop_flag.is_set() and time.monotonic() - started < IDLE_REFRESH:
+            if not has_unread_response(mail):
+                readable, _, _ = select.select([mail.sock], [], [], POLL_INTERVAL)
+                if not readable:
+                    continue
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if line.startswith(b"* BYE"):
+                raise imaplib.IMAP4.abort(line.decode(errors="replace").strip())
+            new_mail = bool(EXISTS_REGEX.match(line))
+
+        mail.send(b"DONE\r\n")
+        # Read up to the IDLE's tagged completion, skipping any untagged responses sent before it
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+            if line.startswith(tag):
+                break
+        return new_mail
+
+    def organize_new_emails(self):
+        """
+        Finds the emails that arrived since the last ones organized and applies the sender rules to them
+        (and the AI organizer, if enabled). The rules are reloaded every time, so changes made on the
+        Sender List page apply to the next email that arrives.
+        """
+        with borrow_connection() as mail:
+            select_mailbox(mail, TARGET_MAILBOX)
+            _, data = mail.uid("SEARCH", None, f"UID {self.last_uid + 1}:*")
+            # "n:*" always matches the highest UID, even when it's lower than n
+            uids = [uid for uid in parse_search_response(data) if uid > self.last_uid]
+            if not uids:
+                return
+
+            print(f"IDLE Daemon > {len(uids)} new emails arrived")
+            # A handful of new emails is cheaper to organize by reading their senders than with a search per rule
+            if organize_emails(mail, uids, get_sender_rules(), self.stop_flag) and self.use_ai:
+                ai_email_organizer.organize_emails(mail, uids, self.client, self.stop_flag)
+            if not self.stop_flag.is_set():
+                self.last_uid = max(uids)
+
+    def run(self):
+        """
+        Organizes new emails as they arrive until the stop flag is set, reconnecting whenever the connection drops.
+        """
+        delay = 1
+        while not self.stop_flag.is_set():
+            mail = None
+            try:
+                mail = self.connect()
+                delay = 1
+                print("IDLE Daemon > Waiting for new emails...")
+                # Catch up on anything that arrived while the daemon was reconnecting
+                self.organize_new_emails()
+                while not self.stop_flag.is_set():
+                    if self.idle(mail):
+                        self.organize_new_emails()
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+                print(f"IDLE Daemon > Connection lost ({e}), reconnecting in {delay} seconds...")
+                self.stop_flag.wait(delay)
+                delay = min(MAX_RECONNECT_DELAY, delay * 2)
+            finally:
+                if mail is not None:
+                    close_connection(mail)
+
+        print("IDLE Daemon > Stopped")
+
+def idle_daemon(stop_flag=None, use_ai=False):
+    """
+    Main function for the IDLE daemon. Blocks until the stop flag is set.
+
+    @param stop_flag: threading.Event object that stops the daemon when set (optional)
+    @param use_ai: True to also organize new emails with the AI organizer
+    """
+    IdleDaemon(stop_flag, use_ai).run()
+
+if __name__ == "__main__":
+    stop_flag = threading.Event()
+    try:
+        idle_daemon(stop_flag, use_ai="--ai" in sys.argv[1:])
+    except KeyboardInterrupt:
+        stop_flag.set()
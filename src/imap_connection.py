@@ -0,0 +1,324 @@
+"""
+This file contains the shared IMAP connection pool used by every part of the application
+that talks to the Gmail server.
+
+Connections are logged in once and then borrowed and returned by the organizers, the sender
+scan, sender deletion and the inbox reset, instead of each of them doing its own TLS handshake
+and login. Idle connections are health checked with a NOOP before being handed out again and are
+logged out once they've been sitting in the pool for too long.
+"""
+
+import configparser
+import imaplib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+IMAP_HOST = "imap.gmail.com"
+CONFIG_FILE = "config.ini"
+CONNECT_ATTEMPTS = 3
+
+MAX_CONNECTIONS = 10        # most connections the pool will have open at once
+IDLE_TIMEOUT = 600          # seconds a connection may sit unused in the pool before it's logged out
+HEALTH_CHECK_INTERVAL = 60  # seconds a connection may sit unused before it's checked with a NOOP
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+def load_credentials():
+    """
+    Reads the Gmail credentials from the config.ini file. The file is only read once per process.
+
+    @return: tuple containing the email address and the app password
+    """
+    global _credentials
+
+    with _credentials_lock:
+        if _credentials is None:
+            config = configparser.ConfigParser()
+            config.read(CONFIG_FILE)
+            _credentials = (config["gmail"]["email"], config["gmail"]["password"])
+        return _credentials
+
+def open_connection():
+    """
+    Opens a new, logged in connection to the gmail server. Most callers should borrow a connection
+    from the pool with borrow_connection() instead of calling this directly.
+
+    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
+    """
+    email_address, password = load_credentials()
+
+    for attempt in range(CONNECT_ATTEMPTS):
+        try:
+            mail = imaplib.IMAP4_SSL(IMAP_HOST)
+            break
+        except Exception as e:
+            if attempt < CONNECT_ATTEMPTS - 1:
+                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
+            else:
+                raise Exception(f"Failed to connect to {IMAP_HOST} after {attempt+1} attempts: {e}")
+    mail.login(email_address, password)
+
+    # The capabilities advertised before login don't include extensions like CONDSTORE
+    _, data = mail.capability()
+    mail.capabilities = tuple(data[-1].decode().upper().split())
+
+    print("IMAP Connection Pool > Connection established to Gmail server")
+    return mail
+
+def close_connection(mail):
+    """
+    Logs out of a connection, ignoring any errors from a connection that has already dropped.
+
+    @param mail: imaplib.IMAP4_SSL object to log out of
+    """
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+def check_response(response, command):
+    """
+    Checks the (result, data) tuple returned by an imaplib command.
+
+    @param command: name of the command, for the error message (e.g. "UID STORE")
+
+    @return: the response's data
+    @raise imaplib.IMAP4.error: if the server didn't answer "OK"
+    """
+    result, data = response
+    if result != "OK":
+        text = b" ".join(item for item in data or [] if isinstance(item, bytes)).decode(errors="replace")
+        raise imaplib.IMAP4.error(f"{command} failed: {result} {text}".strip())
+    return data
+
+class ConnectionInfo:
+    """
+    Bookkeeping the pool keeps for each of its connections.
+    """
+    def __init__(self):
+        self.last_used = time.monotonic()
+        self.mailbox = None
+        self.readonly = False
+        self.select_data = None
+        self.uidvalidity = None
+
+class ConnectionPool:
+    def __init__(self, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+      health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = []
+        self._info = {}
+        self._open = 0
+        self._pid = os.getpid()
+
+    def _reset_if_forked(self):
+        """
+        A forked child process inherits the parent's sockets, which it must never use.
+        Forget about them (without logging out, since they still belong to the parent).
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._info = {}
+            self._open = 0
+
+    def _evict_idle(self):
+        """
+        Removes connections that have been idle for longer than the idle timeout.
+        Must be called with the lock held.
+
+        @return: list of evicted connections, to be logged out once the lock is released
+        """
+        now = time.monotonic()
+        evicted = [mail for mail in self._idle if now - self._info[mail].last_used > self.idle_timeout]
+        for mail in evicted:
+            self._idle.remove(mail)
+            del self._info[mail]
+            self._open -= 1
+        return evicted
+
+    def _is_healthy(self, mail):
+        if time.monotonic() - self._info[mail].last_used < self.health_check_interval:
+            return True
+        try:
+            result, _ = mail.noop()
+            return result == "OK"
+        except Exception:
+            return False
+
+    def checkout(self):
+        """
+        Borrows a connection from the pool, opening a new one if none are idle.
+        Blocks while the pool is at its connection limit.
+
+        @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
+        """
+        while True:
+            with self._lock:
+                self._reset_if_forked()
+                evicted = self._evict_idle()
+                while not self._idle and self._open >= self.max_connections:
+                    self._available.wait()
+                if self._idle:
+                    mail = self._idle.pop()
+                else:
+                    mail = None
+                    self._open += 1
+
+            for stale in evicted:
+                close_connection(stale)
+
+            if mail is None:
+                try:
+                    mail = open_connection()
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                        self._available.notify()
+                    raise
+                with self._lock:
+                    self._info[mail] = ConnectionInfo()
+                return mail
+
+            if self._is_healthy(mail):
+                return mail
+            self.checkin(mail, discard=True)
+
+    def checkin(self, mail, discard=False):
+        """
+        Returns a borrowed connection to the pool.
+
+        @param mail: the connection being returned
+        @param discard: True if the connection is broken and should be logged out instead of reused
+        """
+        with self._lock:
+            if mail not in self._info:
+                # The connection was opened before a fork, or the pool has been closed.
+                return
+            if discard or mail.state == "LOGOUT":
+                del self._info[mail]
+                self._open -= 1
+            else:
+                self._info[mail].last_used = time.monotonic()
+                self._idle.append(mail)
+                mail = None
+            self._available.notify()
+
+        if mail is not None:
+            close_connection(mail)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a connection for the duration of a with-block.
+        Connections that fail with a network error are discarded rather than returned.
+        """
+        mail = self.checkout()
+        try:
+            yield mail
+        except (imaplib.IMAP4.abort, OSError):
+            self.checkin(mail, discard=True)
+            raise
+        except BaseException:
+            self.checkin(mail)
+            raise
+        else:
+            self.checkin(mail)
+
+    def select(self, mail, mailbox, readonly=False):
+        """
+        Selects a mailbox on a pooled connection, skipping the SELECT if the connection
+        already has that mailbox selected.
+
+        @param mail: a connection borrowed from this pool
+        @param mailbox: name of the mailbox to select
+        @param readonly: True to open the mailbox with EXAMINE instead of SELECT
+
+        @return: the (result, data) tuple from the SELECT command
+        """
+        info = self._info.get(mail)
+        if info is None:
+            return mail.select(mailbox, readonly)
+
+        if mail.state == "SELECTED" and info.mailbox == mailbox and info.readonly == readonly:
+            return "OK", info.select_data
+
+        result, data = mail.select(mailbox, readonly)
+        if result == "OK":
+            info.mailbox = mailbox
+            info.readonly = readonly
+            info.select_data = data
+            uidvalidity = mail.response("UIDVALIDITY")[1]
+            info.uidvalidity = int(uidvalidity[-1]) if uidvalidity and uidvalidity[-1] else None
+        else:
+            info.mailbox = None
+        return result, data
+
+    def selected_uidvalidity(self, mail):
+        """
+        @return: the UIDVALIDITY of the mailbox currently selected on a pooled connection, or None
+        """
+        info = self._info.get(mail)
+        return info.uidvalidity if info and info.mailbox else None
+
+    def invalidate_selection(self, mail):
+        """
+        Forgets the cached selection for a connection, e.g. after it has been CLOSEd.
+        """
+        info = self._info.get(mail)
+        if info:
+            info.mailbox = None
+
+    def close_all(self):
+        """
+        Logs out of every idle connection in the pool.
+        """
+        with self._lock:
+            self._reset_if_forked()
+            idle, self._idle = self._idle, []
+            for mail in idle:
+                del self._info[mail]
+                self._open -= 1
+            self._available.notify_all()
+
+        for mail in idle:
+            close_connection(mail)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    @return: the process-wide ConnectionPool, created on first use
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+def borrow_connection():
+    """
+    Borrows a connection from the process-wide pool for the duration of a with-block:
+
+        with borrow_connection() as mail:
+            select_mailbox(mail, TARGET_MAILBOX)
+            ...
+    """
+    return get_pool().connection()
+
+def select_mailbox(mail, mailbox, readonly=False):
+    """
+    Selects a mailbox on a connection borrowed from the process-wide pool, reusing the current
+    selection when possible. See ConnectionPool.select().
+    """
+    return get_pool().select(mail, mailbox, readonly)
@@ -0,0 +1,150 @@
+"""
+This file contains the delta sync layer, which uses the IMAP CONDSTORE extension to find out which
+emails were added or relabelled in a mailbox since a job last ran to completion.
+
+Each job (e.g. the standard organizer) keeps its own checkpoint in the sender store: the mailbox's
+UIDVALIDITY and HIGHESTMODSEQ at the time the job's last successful run started. On the next run,
+only emails whose MODSEQ is higher than the checkpoint need to be looked at.
+
+Typical usage:
+
+    delta = start_sync(mail, TARGET_MAILBOX, "standard_organizer")
+    uids = search_changed(mail, delta, '(NOT X-GM-LABELS "...")')
+    ... process uids ...
+    commit_sync(delta)
+"""
+
+import re
+
+from . import sender_store
+from .imap_connection import select_mailbox
+from .uid_sets import parse_search_response
+
+STATUS_REGEX = re.compile(rb'(HIGHESTMODSEQ|UIDVALIDITY) (\d+)')
+
+class MailboxDelta:
+    """
+    The changes to a mailbox since a job's last checkpoint.
+
+    full_sync is True when there is no usable checkpoint (first run, UIDVALIDITY changed, or the
+    server doesn't support CONDSTORE), in which case the job has to look at the whole mailbox.
+    """
+    def __init__(self, job, mailbox, uidvalidity, highestmodseq, since_modseq, full_sync):
+        self.job = job
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.highestmodseq = highestmodseq
+        self.since_modseq = since_modseq
+        self.full_sync = full_sync
+        self.changed_uids = None
+
+    def has_changes(self):
+        return self.full_sync or self.highestmodseq != self.since_modseq
+
+    def __str__(self):
+        if self.full_sync:
+            return f"{self.mailbox}: full sync"
+        return f"{self.mailbox}: MODSEQ {self.since_modseq} -> {self.highestmodseq}"
+
+def load_sync_state():
+    """
+    @return: dict mapping each job to a dict mapping each mailbox to its checkpoint
+    """
+    return sender_store.get_meta("sync_state", {})
+
+def reset_sync_state(job=None):
+    """
+    Forgets the checkpoints of one job (or of every job), forcing a full sync on its next run.
+    """
+    if job is None:
+        sender_store.delete_meta("sync_state")
+        return
+
+    def forget_job(state):
+        state.pop(job, None)
+        return state
+    sender_store.update_meta("sync_state", forget_job, {})
+
+def supports_condstore(mail):
+    return "CONDSTORE" in mail.capabilities
+
+def get_mailbox_status(mail, mailbox):
+    """
+    Reads a mailbox's UIDVALIDITY and HIGHESTMODSEQ with a STATUS command, which doesn't depend
+    on which mailbox (if any) the connection currently has selected.
+
+    @return: tuple containing the UIDVALIDITY and HIGHESTMODSEQ (None if the server doesn't support CONDSTORE)
+    """
+    items = "(UIDVALIDITY HIGHESTMODSEQ)" if supports_condstore(mail) else "(UIDVALIDITY)"
+    _, data = mail.status(mailbox, items)
+    values = dict(STATUS_REGEX.findall(data[0] or b""))
+
+    uidvalidity = int(values[b"UIDVALIDITY"]) if b"UIDVALIDITY" in values else None
+    highestmodseq = int(values[b"HIGHESTMODSEQ"]) if b"HIGHESTMODSEQ" in values else None
+    return uidvalidity, highestmodseq
+
+def start_sync(mail, mailbox, job, full_sync=False):
+    """
+    Works out what changed in a mailbox since the job's last checkpoint, and selects the mailbox.
+
+    @param mailbox: name of the mailbox to sync
+    @param job: name of the job the checkpoint belongs to (e.g. "standard_organizer")
+    @param full_sync: True to ignore the checkpoint and treat every email as changed
+
+    @return: MailboxDelta, to be passed to commit_sync() once the job has finished successfully
+    """
+    uidvalidity, highestmodseq = get_mailbox_status(mail, mailbox)
+
+    checkpoint = load_sync_state().get(job, {}).get(mailbox)
+
+    usable = (
+        not full_sync
+        and highestmodseq is not None
+        and checkpoint is not None
+        and checkpoint["uidvalidity"] == uidvalidity
+    )
+    since_modseq = checkpoint["modseq"] if usable else None
+    delta = MailboxDelta(job, mailbox, uidvalidity, highestmodseq, since_modseq, not usable)
+
+    select_mailbox(mail, mailbox)
+    print(f"Mailbox Sync > {job} > {delta}")
+    return delta
+
+def search_changed(mail, delta, criteria="ALL"):
+    """
+    Runs a UID SEARCH restricted to the emails that changed since the delta's checkpoint.
+    When a full sync is needed, the search covers the whole mailbox.
+
+    @param delta: MailboxDelta from start_sync()
+    @param criteria: IMAP search criteria the changed emails must also match
+
+    @return: list of email UIDs
+    """
+    if not delta.has_changes():
+        delta.changed_uids = []
+        return []
+
+    select_mailbox(mail, delta.mailbox)
+    if delta.full_sync:
+        _, data = mail.uid("SEARCH", None, criteria)
+    else:
+        _, data = mail.uid("SEARCH", None, f"(MODSEQ {delta.since_modseq + 1} {criteria})")
+
+    delta.changed_uids = parse_search_response(data)
+    return delta.changed_uids
+
+def commit_sync(delta):
+    """
+    Records the delta's HIGHESTMODSEQ as the job's new checkpoint.
+    Only call this once the job has processed every change in the delta.
+    """
+    if delta.highestmodseq is None:
+        return
+
+    def save_checkpoint(state):
+        state.setdefault(delta.job, {})[delta.mailbox] = {
+            "uidvalidity": delta.uidvalidity,
+            "modseq": delta.highestmodseq
+        }
+        return state
+    sender_store.update_meta("sync_state", save_checkpoint, {})
@@ -0,0 +1,279 @@
+"""
+This file contains the dry-run planner, which works out what the standard organizer and sender deletion
+would do, without changing anything in the mailbox.
+
+The plan is built from the sender store and a pass of cheap UID SEARCH commands: how many emails each
+rule (and each sender deletion) would touch, how many IMAP commands each organizing mode would send,
+and roughly how long the run would take. The estimate uses the round trip time of the planning searches
+and the per-email latency the adaptive controller has learned, so it gets better once a run has happened.
+
+    python -m src.planner                     plan the next standard organizer run, in both modes
+    python -m src.planner a@b.com c@d.com     plan deleting the emails from these senders
+"""
+
+import statistics
+import sys
+import time
+
+from . import sender_store
+from .adaptive_concurrency import get_controller
+from .email_organizer import (
+    RULE_SEARCH_SIZE, SYNC_JOB, TARGET_MAILBOX, fetch_uids, get_sender_rules, get_shard_count, search_rule
+)
+from .imap_connection import borrow_connection
+from .mailbox_sync import start_sync
+from .rm_from_sender import SENDER_SEARCH_SIZE, fetch_uids_from_sender, supports_move
+from .uid_sets import chunk_uids, sort_uids
+
+DEFAULT_ROUND_TRIP = 0.2          # seconds per command, when no planning search was timed
+DEFAULT_SECONDS_PER_EMAIL = 0.002  # when the adaptive controller hasn't learned the latency yet
+
+class Plan:
+    """
+    What a run would do: how many emails it would touch (per rule, label or sender), how many
+    IMAP commands of each kind it would send, and an estimate of how long it would take.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.emails = 0
+        self.counts = {}
+        self.commands = {}
+        self.command_emails = 0  # emails covered by the commands, added up over every command
+        self.duration = 0.0
+        self.notes = []
+
+    def add_commands(self, command, count):
+        if count:
+            self.commands[command] = self.commands.get(command, 0) + count
+
+    def total_commands(self):
+        return sum(self.commands.values())
+
+    def __str__(self):
+        lines = [f"{self.name}: {self.emails} emails, {self.total_commands()} commands, ~{format_duration(self.duration)}"]
+        lines += [f"    {key}: {count} emails" for key, count in self.counts.items()]
+        lines += [f"    {command} commands: {count}" for command, count in self.commands.items()]
+        lines += [f"    Note: {note}" for note in self.notes]
+        return "\n".join(lines)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours: return f"{hours}h {minutes}m"
+    if minutes: return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+class SearchTimer:
+    """
+    Runs the planning searches and keeps their round trip times, to estimate the cost of every other command.
+    """
+    def __init__(self):
+        self.times = []
+
+    def run(self, search, *args):
+        start = time.monotonic()
+        result = search(*args)
+        self.times.append(time.monotonic() - start)
+        return result
+
+    def round_trip(self):
+        return statistics.median(self.times) if self.times else DEFAULT_ROUND_TRIP
+
+def estimate_duration(commands, emails, round_trip, controller, connections=1):
+    """
+    @param commands: number of commands the run would send
+    @param emails: number of emails covered by those commands, added up over every command
+    @param round_trip: seconds per command
+    @param controller: AdaptiveController of the operation being planned, for its per-email latency
+    @param connections: number of connections the commands are spread over
+
+    @return: estimated duration in seconds
+    """
+    per_email = controller.item_latency or DEFAULT_SECONDS_PER_EMAIL
+    return (commands * round_trip + emails * per_email) / max(connections, 1)
+
+def count_rule_matches(mail, uids, rules, timer):
+    """
+    Works out which rule applies to each email with the same searches the server mode uses:
+    exact address rules first, then domain rules.
+
+    @return: tuple containing a dict mapping each matched UID to its action, the number of exact rule
+             searches, and the set of UIDs a domain rule could apply to
+    """
+    pending = set(uids)
+    uid_range = f"{min(pending)}:{max(pending)}"
+    actions = {}
+
+    addresses_by_action = {}
+    for address, action in rules.exact.items():
+        addresses_by_action.setdefault(action, []).append(address)
+
+    exact_searches = 0
+    for action, addresses in addresses_by_action.items():
+        for i in range(0, len(addresses), RULE_SEARCH_SIZE):
+            for uid in timer.run(search_rule, mail, addresses[i:i + RULE_SEARCH_SIZE], uid_range):
+                if uid in pending:
+                    actions[uid] = action
+                    pending.discard(uid)
+            exact_searches += 1
+
+    # Domain rules are searched per action, so that the emails they could apply to can be counted per label
+    domains_by_action = {}
+    for domain, action in list(rules.domains.items()) + list(rules.subdomains.items()):
+        domains_by_action.setdefault(action, []).append(domain)
+
+    domain_candidates = set()
+    for action, domains in domains_by_action.items():
+        for i in range(0, len(domains), RULE_SEARCH_SIZE):
+            for uid in timer.run(search_rule, mail, domains[i:i + RULE_SEARCH_SIZE], uid_range):
+                if uid in pending:
+                    actions.setdefault(uid, action)
+                    domain_candidates.add(uid)
+
+    return actions, exact_searches, domain_candidates
+
+def plan_server_mode(uids, rules, actions, exact_searches, domain_candidates, batch_size):
+    """
+    Counts the commands organize_emails_on_server() would send.
+    """
+    plan = Plan("Standard Email Organizer (server mode)")
+    pending = set(uids) - {uid for uid, action in actions.items() if uid not in domain_candidates}
+
+    plan.add_commands("SEARCH", exact_searches)
+    if rules.patterns:
+        candidates = pending
+    else:
+        candidates = domain_candidates
+        domains = rules.searchable_domains()
+        plan.add_commands("SEARCH", -(-len(domains) // RULE_SEARCH_SIZE))
+    plan.add_commands("FETCH", sum(len(chunk_uids(chunk)) for chunk in chunk_uids(candidates, batch_size)))
+
+    uids_by_action = {}
+    for uid in uids:
+        uids_by_action.setdefault(actions.get(uid), []).append(uid)
+    plan.add_commands("STORE", sum(len(chunk_uids(action_uids, batch_size)) for action_uids in uids_by_action.values()))
+
+    plan.emails = len(uids)
+    plan.command_emails = len(candidates) + len(uids)
+    return plan
+
+def plan_fetch_mode(uids, actions, batch_size):
+    """
+    Counts the commands organize_emails() would send.
+    """
+    plan = Plan("Standard Email Organizer (fetch mode)")
+    uids = sort_uids(uids)
+
+    for position in range(0, len(uids), batch_size):
+        batch = uids[position:position + batch_size]
+        plan.add_commands("FETCH", len(chunk_uids(batch)))
+        uids_by_action = {}
+        for uid in batch:
+            uids_by_action.setdefault(actions.get(uid), []).append(uid)
+        plan.add_commands("STORE", sum(len(chunk_uids(action_uids)) for action_uids in uids_by_action.values()))
+
+    plan.emails = len(uids)
+    plan.command_emails = 2 * len(uids)  # every email is fetched, then stored
+    return plan
+
+def plan_organizer(full_sync=False, shards=None):
+    """
+    Plans the next run of the standard organizer, in both organizing modes.
+
+    @param full_sync: True to plan a run over the whole mailbox instead of only the emails changed since the last run
+    @param shards: number of connections the run would use (optional, see email_organizer.get_shard_count())
+
+    @return: dict mapping each mode ("server" and "fetch") to its Plan
+    """
+    rules = get_sender_rules()
+    timer = SearchTimer()
+
+    with borrow_connection() as mail:
+        delta = timer.run(start_sync, mail, TARGET_MAILBOX, SYNC_JOB, full_sync)
+        uids = timer.run(fetch_uids, mail, delta)
+        if uids:
+            actions, exact_searches, domain_candidates = count_rule_matches(mail, uids, rules, timer)
+        else:
+            actions, exact_searches, domain_candidates = {}, 0, set()
+
+    controller = get_controller("Standard Email Organizer")
+    batch_size = controller.batch_size
+    connections = get_shard_count(len(uids), shards)
+    plans = {
+        "server": plan_server_mode(uids, rules, actions, exact_searches, domain_candidates, batch_size),
+        "fetch": plan_fetch_mode(uids, actions, batch_size)
+    }
+
+    counts = {}
+    for action in actions.values():
+        counts[action] = counts.get(action, 0) + 1
+    counts["No rule (marked as checked)"] = len(uids) - len(actions)
+
+    for plan in plans.values():
+        plan.counts = dict(counts)
+        plan.duration = estimate_duration(plan.total_commands(), plan.command_emails, timer.round_trip(), controller, connections)
+        if connections > 1:
+            plan.notes.append(f"Split over {connections} connections")
+        if rules.patterns:
+            plan.notes.append(f"{len(rules.patterns)} pattern rules can't be searched for, so their emails are counted under 'No rule'")
+        if rules.domains or rules.subdomains:
+            plan.notes.append("Domain rule counts are estimates, since Gmail's from: search also matches similar domains")
+
+    return plans
+
+def plan_sender_rules():
+    """
+    Lists every sender rule with the number of emails the last sender scan found from that sender,
+    without contacting the server.
+
+    @return: list of (email address, label or "Unsubscribed", email count) tuples, largest first
+    """
+    frequencies = {address: info["frequency"] for address, info in sender_store.get_senders()}
+    rules = [(address, action, frequencies.get(address, 0)) for address, action in sender_store.get_sender_rules().items()]
+    return sorted(rules, key=lambda rule: rule[2], reverse=True)
+
+def plan_delete(senders):
+    """
+    Plans deleting every email from the given senders with rm_from_senders(). Each sender is counted
+    with its own search here, so that the plan doesn't need to read any headers.
+
+    @param senders: list of sender email addresses
+
+    @return: Plan, with the number of emails found from each sender
+    """
+    plan = Plan("Remove Emails from Sender")
+    timer = SearchTimer()
+    controller = get_controller("Remove Emails from Sender")
+    batch_size = controller.batch_size
+    uids = set()
+
+    with borrow_connection() as mail:
+        move = supports_move(mail)
+        for sender in senders:
+            sender_uids = timer.run(fetch_uids_from_sender, mail, sender)
+            plan.counts[sender] = len(sender_uids)
+            uids.update(sender_uids)
+
+    plan.emails = len(uids)
+    plan.add_commands("SEARCH", -(-len(senders) // SENDER_SEARCH_SIZE))
+    if len(senders) > 1:
+        plan.add_commands("FETCH", len(chunk_uids(uids, batch_size)))  # to tell the senders' emails apart
+    plan.add_commands("MOVE" if move else "STORE", len(chunk_uids(uids, batch_size)))
+    if uids and not move:
+        plan.add_commands("EXPUNGE", 1)
+    plan.command_emails = plan.emails * (2 if len(senders) > 1 else 1)
+
+    plan.duration = estimate_duration(plan.total_commands(), plan.command_emails, timer.round_trip(), controller)
+    return plan
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(plan_delete(sys.argv[1:]))
+    else:
+        for address, action, frequency in plan_sender_rules():
+            print(f"Planner > {address} -> {action} ({frequency} emails at the last scan)")
+        plans = plan_organizer()
+        for plan in plans.values():
+            print(plan)
+        fastest = min(plans, key=lambda mode: plans[mode].duration)
+        print(f"Planner > The {fastest} mode should be the fastest")
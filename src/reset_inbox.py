@@ -6,56 +6,35 @@ Author: Michael Camerato
 Date: 8/18/24
 """
 
-import imaplib
-import configparser
 import json
 import os
-import re
 import tqdm
 
+from . import sender_store
+from .adaptive_concurrency import get_controller
+from .gmail_labels import parse_list_response, quote_label
+from .imap_connection import borrow_connection, select_mailbox
+from .mailbox_sync import reset_sync_state
+from .sender_scan import reset_scan_state
+from .uid_sets import MAX_SET_LENGTH, chunk_uids, compress_uids, parse_search_response
+
 TARGET_MAILBOX = '"[Gmail]/All Mail"'
-SENDER_LABELS_FILE = "src/data/sender_labels.json"
-UNSUBSCRIBED_FILE = "src/data/unsubscribed.json"
 CATEGORIES_FILE = "src/data/data.json"
-SENDER_LIST_FILE = "src/data/senders.json"
-
-def establish_connection():
-    """
-    Establishes a connection to the gmail server using the credentials in the config.ini file.
-
-    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
-    """
-
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    email_address = config["gmail"]["email"]
-    password = config["gmail"]["password"]
 
-    for attempt in range(3):
-        try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            break
-        except Exception as e:
-            if attempt < 2:
-                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
-            else:
-                raise Exception(f"Failed to connect to imap.gmail.com after {attempt+1} attempts: {e}")
-    mail.login(email_address, password)
-    mail.login(email_address, password)
-
-    print("Reset Inbox > Connection established to Gmail server")
-    return mail
+ORGANIZER_LABEL_ROOT = "Email Organizer"
+STANDARD_ORGANIZER_LABEL_ROOT = "Email Organizer/Standard Organizer"
+AI_ORGANIZER_LABEL_ROOT = "Email Organizer/AI Organizer"
+STANDARD_CHECKED_LABEL = "Email Organizer/Standard Organizer/Checked Emails"
+AI_CHECKED_LABEL = "Email Organizer/AI Organizer/AI Checked Emails"
+STANDARD_SYNC_JOB = "standard_organizer"
+AI_SYNC_JOB = "ai_organizer"
+LABEL_LIST_LENGTH = 3000  # most characters of label list to put in one STORE, next to its UID set
 
 def reset_sender_labels():
-    if os.path.exists(SENDER_LABELS_FILE):
-        with open(SENDER_LABELS_FILE, "w") as file:
-            json.dump({"Filter by Label": [], "---": []}, file, indent=4)
+    sender_store.reset_labels()
 
 def reset_unsubscribed_senders():
-    if os.path.exists(UNSUBSCRIBED_FILE):
-        with open(UNSUBSCRIBED_FILE, "w") as file:
-            json.dump({}, file, indent=4)
+    sender_store.reset_unsubscribed()
 
 def reset_categories():
     if os.path.exists(CATEGORIES_FILE):
@@ -63,63 +42,108 @@ def reset_categories():
             json.dump({"categories": []}, file, indent=4)
 
 def reset_sender_list():
-    if os.path.exists(SENDER_LIST_FILE):
-        with open(SENDER_LIST_FILE, "w") as file:
-            json.dump([], file, indent=4)
-
-def get_standard_organizer_uids(mail):
-    mail.select(TARGET_MAILBOX)
-    _, data = mail.uid("SEARCH", None, '(X-GM-LABELS "Email Organizer/Standard Organizer/Checked Emails")')
-    uids = data[0].split()
-    print(f'Standard Organizer UIDs: {len(uids)}')
-    return uids
+    sender_store.reset_senders()
+    reset_scan_state()
+
+def get_organizer_uids(mail, checked_labels):
+    """
+    Finds every email that has been checked by any of the given organizers, with a single search.
 
-def get_ai_organizer_uids(mail):
-    mail.select(TARGET_MAILBOX)
-    _, data = mail.uid("SEARCH", None, '(X-GM-LABELS "Email Organizer/AI Organizer/AI Checked Emails")')
-    uids = data[0].split()
-    print(f'AI Organizer UIDs: {len(uids)}')
+    @param checked_labels: the organizers' "checked" labels
+
+    @return: list of email UIDs
+    """
+    select_mailbox(mail, TARGET_MAILBOX)
+    # OR takes two search keys, so n labels are combined as "OR OR X-GM-LABELS a X-GM-LABELS b X-GM-LABELS c"
+    criteria = "OR " * (len(checked_labels) - 1) + " ".join(f"X-GM-LABELS {quote_label(label)}" for label in checked_labels)
+    _, data = mail.uid("SEARCH", None, f"({criteria})")
+    uids = parse_search_response(data)
+    print(f"Reset Inbox > Found {len(uids)} organized emails")
     return uids
 
-def get_labels(mail, uid, label_type=None):
-    _, data = mail.uid("FETCH", uid, "(X-GM-LABELS)")
-    raw_string = data[0].decode("utf-8")
-    match = re.search(r'\(X-GM-LABELS \((.*?)\) UID \d+\)', raw_string)
-    labels = re.findall(r'"([^"]+)"', match.group(1))
-    if label_type:
-        return [label for label in labels if label_type in label]
+def list_organizer_labels(mail, root=ORGANIZER_LABEL_ROOT):
+    """
+    Lists the labels created by the organizers with a single LIST command.
+
+    @param root: only list the labels nested under this label, e.g. "Email Organizer/AI Organizer"
+
+    @return: list of label names
+    """
+    _, data = mail.list('""', quote_label(f"{root}/*"))
+    labels = parse_list_response(data)
+    print(f"Reset Inbox > Found {len(labels)} labels under '{root}'")
     return labels
 
+def group_labels(labels, max_length=LABEL_LIST_LENGTH):
+    """
+    Splits a list of labels into parenthesized label lists for X-GM-LABELS, none longer than max_length.
+
+    @return: list of label list strings, e.g. ['("a" "b")', '("c")']
+    """
+    groups, group, length = [], [], 0
+    for label in map(quote_label, labels):
+        if group and length + len(label) + 1 > max_length:
+            groups.append(group)
+            group, length = [], 0
+        group.append(label)
+        length += len(label) + 1
+    if group:
+        groups.append(group)
+    return [f"({' '.join(group)})" for group in groups]
+
+def remove_labels(mail, uids, labels, desc, progress_callback=None):
+    """
+    Removes a set of labels from every one of the given emails, a chunk of UIDs and a group of labels
+    per UID STORE. Emails that don't have some of the labels are left as they are.
+
+    @param uids: list of email UIDs
+    @param labels: list of label names
+    @param progress_callback: function to call with the progress of the removal (optional)
+    """
+    controller = get_controller("Reset Inbox")
+    label_lists = group_labels(labels)
+
+    with tqdm.tqdm(total=len(uids) * len(label_lists), desc=desc) as pbar:
+        for label_list in label_lists:
+            for chunk in chunk_uids(uids, controller.batch_size, MAX_SET_LENGTH - LABEL_LIST_LENGTH):
+                controller.call(mail.uid, "STORE", compress_uids(chunk), "-X-GM-LABELS", label_list, items=len(chunk))
+                pbar.update(len(chunk))
+                if progress_callback:
+                    progress_callback(pbar.format_dict['n'] / pbar.format_dict['total'], pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+
+def remove_organizer_labels(standard=True, ai=True, progress_callback=None):
+    """
+    Removes the labels of the Standard Organizer and/or the AI Organizer from every email they've checked.
+    When both are reset, it's done in one pass over the emails checked by either of them, over one connection.
+    The organizers' delta sync checkpoints are forgotten too, so their next runs look at the whole mailbox.
+
+    @param standard: True to remove the Standard Organizer's labels
+    @param ai: True to remove the AI Organizer's labels
+    @param progress_callback: function to call with the progress of the removal (optional)
+    """
+    organizers = [
+        (root, checked_label, job) for root, checked_label, job, enabled in (
+            (STANDARD_ORGANIZER_LABEL_ROOT, STANDARD_CHECKED_LABEL, STANDARD_SYNC_JOB, standard),
+            (AI_ORGANIZER_LABEL_ROOT, AI_CHECKED_LABEL, AI_SYNC_JOB, ai)
+        ) if enabled
+    ]
+    if not organizers:
+        return
+
+    # Forgotten first, so a reset that's interrupted part way through still leads to a full sync
+    for _, _, job in organizers:
+        reset_sync_state(job)
+
+    with borrow_connection() as mail:
+        labels = [
+            label for label in list_organizer_labels(mail)
+            if any(label.startswith(root + "/") for root, _, _ in organizers)
+        ]
+        uids = get_organizer_uids(mail, [checked_label for _, checked_label, _ in organizers])
+        remove_labels(mail, uids, labels, "Reset Inbox > Removing organizer labels from UIDs", progress_callback)
+
 def remove_standard_organizer_labels(progress_callback=None):
-    mail = establish_connection()
-    uids = get_standard_organizer_uids(mail)
-
-    counter = 0
-    total_uids = len(uids)
-
-    with tqdm.tqdm(total=total_uids, desc="Reset Inbox > Removing 'Standard Organizer' labels from UIDs") as pbar:
-        for uid in uids:
-            labels = get_labels(mail, uid, label_type="Standard Organizer")
-            for label in labels:
-                mail.uid("STORE", uid, "-X-GM-LABELS", f'"{label}"')
-            counter += 1
-            if progress_callback:
-                progress_callback(counter / total_uids, pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
-            pbar.update(1)
+    remove_organizer_labels(standard=True, ai=False, progress_callback=progress_callback)
 
 def remove_ai_organizer_labels(progress_callback=None):
-    mail = establish_connection()
-    uids = get_ai_organizer_uids(mail)
-
-    counter = 0
-    total_uids = len(uids)
-
-    with tqdm.tqdm(total=total_uids, desc="Reset Inbox > Removing 'AI Organizer' labels from UIDs") as pbar:
-        for uid in uids:
-            labels = get_labels(mail, uid, label_type="AI Organizer")
-            for label in labels:
-                mail.uid("STORE", uid, "-X-GM-LABELS", f'"{label}"')
-            counter += 1
-            if progress_callback:
-                progress_callback(counter / total_uids, pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
-            pbar.update(1)
+    remove_organizer_labels(standard=False, ai=True, progress_callback=progress_callback)
@@ -1,43 +1,24 @@
 """
-This file contains the logic for removing all emails from a specific sender from the user's inbox.
+This file contains the logic for removing all emails from a specific sender (or from several senders
+at once) from the user's inbox.
 
 Author: Michael Camerato
 Date: 8/4/24
 """
 
-import imaplib
-import configparser
 import tqdm
 
-TARGET_MAILBOX = '"[Gmail]/All Mail"'
-
-def establish_connection():
-    """
-    Establishes a connection to the gmail server using the credentials in the config.ini file.
-
-    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
-    """
-
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+from .adaptive_concurrency import get_controller
+from .header_parser import parse_from_header
+from .imap_connection import borrow_connection, check_response, select_mailbox
+from .uid_sets import chunk_uids, compress_uids, parse_fetch_literals, parse_search_response
 
-    email_address = config["gmail"]["email"]
-    password = config["gmail"]["password"]
-
-    for attempt in range(3):
-        try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            break
-        except Exception as e:
-            if attempt < 2:
-                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
-            else:
-                raise Exception(f"Failed to connect to imap.gmail.com after {attempt+1} attempts: {e}")
-    mail.login(email_address, password)
-    mail.login(email_address, password)
+TARGET_MAILBOX = '"[Gmail]/All Mail"'
+TRASH_MAILBOX = '"[Gmail]/Trash"'
+SENDER_SEARCH_SIZE = 50  # most senders combined into one SEARCH
 
-    print("Remove Emails from Sender > Connection established to Gmail server")
-    return mail
+def quote(text):
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
 
 def fetch_uids_from_sender(mail, sender):
     """
@@ -49,13 +30,59 @@ def fetch_uids_from_sender(mail, sender):
     @return: a list of email UIDs
     """
 
-    mail.select(TARGET_MAILBOX)
-    _, data = mail.search(None, f'(FROM "{sender}")')
+    select_mailbox(mail, TARGET_MAILBOX)
+    response = mail.uid("SEARCH", None, f'(FROM {quote(sender)})')
 
-    uids = data[0].split()
+    uids = parse_search_response(check_response(response, "UID SEARCH"))
     print(f"Remove Emails from Sender > Found {len(uids)} emails from the email address '{sender}'.")
     return uids
 
+def fetch_uids_from_senders(mail, senders):
+    """
+    Fetches the UIDs of the emails from any of several senders with one combined search
+    (or one per SENDER_SEARCH_SIZE senders), then reads the From header of the emails found
+    to work out which sender each one is from.
+
+    @param senders: list of sender email addresses
+
+    @return: dict mapping each sender to the list of their email UIDs
+    """
+    select_mailbox(mail, TARGET_MAILBOX)
+    controller = get_controller("Remove Emails from Sender")
+
+    uids = set()
+    for i in range(0, len(senders), SENDER_SEARCH_SIZE):
+        group = senders[i:i + SENDER_SEARCH_SIZE]
+        # OR takes two search keys, so n senders are combined as "OR OR FROM a FROM b FROM c"
+        criteria = "OR " * (len(group) - 1) + " ".join(f"FROM {quote(sender)}" for sender in group)
+        response = mail.uid("SEARCH", None, f"({criteria})")
+        uids.update(parse_search_response(check_response(response, "UID SEARCH")))
+
+    uids_by_sender = {sender: [] for sender in senders}
+    if len(senders) == 1:
+        uids_by_sender[senders[0]] = sorted(uids)
+    else:
+        lowered = {sender.lower(): sender for sender in senders}
+        for chunk in chunk_uids(uids, controller.batch_size):
+            response = controller.call(mail.uid, "FETCH", compress_uids(chunk), "(UID BODY.PEEK[HEADER.FIELDS (FROM)])", items=len(chunk))
+            data = check_response(response, "UID FETCH")
+            for uid, raw_header in parse_fetch_literals(data):
+                if uid is None: continue
+                name, address = parse_from_header(raw_header)
+                sender = lowered.get(address.lower())
+                if sender is None:
+                    # FROM matches any part of the header, e.g. the sender's name, so fall back to the first sender that appears in it
+                    header = f"{name} {address}".lower()
+                    sender = next((lowered[s] for s in lowered if s in header), senders[0])
+                uids_by_sender[sender].append(uid)
+
+    for sender, sender_uids in uids_by_sender.items():
+        print(f"Remove Emails from Sender > Found {len(sender_uids)} emails from the email address '{sender}'.")
+    return uids_by_sender
+
+def supports_move(mail):
+    return "MOVE" in getattr(mail, "capabilities", ())
+
 def delete_emails(mail, uids, sender, progress_callback=None):
     """
     This function deletes all emails with the given UIDs
@@ -66,17 +93,68 @@ def delete_emails(mail, uids, sender, progress_callback=None):
     @param progress_callback: a function to call with the progress of the deletion
 
     """
-    with tqdm.tqdm(total=len(uids), desc=f"Deleting {len(uids)} emails from {sender}") as pbar:
-        for uid in uids:
-            mail.store(uid, '+X-GM-LABELS', '\\Trash')
-            pbar.update(1)
-            if progress_callback:
-                progress_callback(pbar.format_dict['n'] / pbar.format_dict['total'])
-    
-    mail.expunge()
-    mail.close()
-    mail.logout()
-    print(f"Remove Emails from Sender > Deleted {len(uids)} emails.")
+    callback = (lambda _, progress: progress_callback(progress)) if progress_callback else None
+    delete_emails_from_senders(mail, {sender: uids}, callback)
+
+def delete_emails_from_senders(mail, uids_by_sender, progress_callback=None):
+    """
+    Deletes the emails of several senders from the user's target mailbox, trashing all of them
+    together a chunk of UIDs at a time.
+
+    The emails are moved to the trash with UID MOVE. If the server doesn't support MOVE, each
+    chunk is given the \\Trash label with a single UID STORE instead.
+
+    @param uids_by_sender: dict mapping each sender to the list of their email UIDs
+    @param progress_callback: a function to call with a sender and the progress of the deletion of
+                              their emails, after every chunk that included some of them (optional)
+
+    @raise imaplib.IMAP4.error: if the server rejects a MOVE or STORE, so the senders aren't reported as deleted
+    """
+    controller = get_controller("Remove Emails from Sender")
+    move = supports_move(mail)
+
+    sender_of = {uid: sender for sender, uids in uids_by_sender.items() for uid in uids}
+    totals = {sender: len(uids) for sender, uids in uids_by_sender.items()}
+    deleted = dict.fromkeys(uids_by_sender, 0)
+
+    with tqdm.tqdm(total=len(sender_of), desc=f"Deleting {len(sender_of)} emails from {len(uids_by_sender)} senders") as pbar:
+        for chunk in chunk_uids(sender_of, controller.batch_size):
+            if move:
+                response = controller.call(mail.uid, "MOVE", compress_uids(chunk), TRASH_MAILBOX, items=len(chunk))
+            else:
+                response = controller.call(mail.uid, "STORE", compress_uids(chunk), "+X-GM-LABELS", "\\Trash", items=len(chunk))
+            check_response(response, "UID MOVE" if move else "UID STORE")
+            pbar.update(len(chunk))
+
+            chunk_senders = {}
+            for uid in chunk:
+                chunk_senders[sender_of[uid]] = chunk_senders.get(sender_of[uid], 0) + 1
+            for sender, count in chunk_senders.items():
+                deleted[sender] += count
+                if progress_callback:
+                    progress_callback(sender, deleted[sender] / totals[sender])
+
+    if not move and sender_of:
+        check_response(mail.expunge(), "EXPUNGE")
+    print(f"Remove Emails from Sender > Deleted {len(sender_of)} emails.")
+
+def rm_from_senders(senders, progress_callback=None):
+    """
+    Removes all emails from several senders from the user's target mailbox, over a single connection.
+
+    @param senders: list of the email addresses of the senders to remove emails from
+    @param progress_callback: a function to call with a sender and the progress of the deletion of their emails (optional)
+
+    @return: dict mapping each sender to the number of their emails that were deleted
+    """
+    with borrow_connection() as mail:
+        uids_by_sender = fetch_uids_from_senders(mail, senders)
+        if progress_callback:
+            for sender, uids in uids_by_sender.items():
+                if not uids: progress_callback(sender, 1.0)
+
+        delete_emails_from_senders(mail, uids_by_sender, progress_callback)
+    return {sender: len(uids) for sender, uids in uids_by_sender.items()}
 
 def rm_from_sender(sender, progress_callback=None):
     """
@@ -86,19 +164,14 @@ def rm_from_sender(sender, progress_callback=None):
     @param sender: The email address of the sender to remove emails from.
     @return: None
     """
-    mail = establish_connection()
-    uids = fetch_uids_from_sender(mail, sender)
-    if len(uids) == 0:
-        print(f"Remove Emails from Sender > No emails found from {sender}.")
-        return
-    
-    delete_emails(mail, uids, sender, progress_callback)
+    callback = (lambda _, progress: progress_callback(progress)) if progress_callback else None
+    rm_from_senders([sender], callback)
 
 if __name__ == "__main__":
     sender = input("Enter the email address of the sender to remove emails from: ")
-    mail = establish_connection()
-    uids = fetch_uids_from_sender(mail, sender)
-    cont = input(f"Are you sure you want to delete {len(uids)} emails from {sender}? (y/n): ")
-    if cont.lower() == "y": delete_emails(mail, uids, sender)
-    else: print("Remove Emails from Sender > Exiting program.")
+    with borrow_connection() as mail:
+        uids = fetch_uids_from_sender(mail, sender)
+        cont = input(f"Are you sure you want to delete {len(uids)} emails from {sender}? (y/n): ")
+        if cont.lower() == "y": delete_emails(mail, uids, sender)
+        else: print("Remove Emails from Sender > Exiting program.")
 
@@ -0,0 +1,121 @@
+"""
+This file contains the rule engine, which decides which sender rule (a label, or "Unsubscribed")
+applies to an email address.
+
+Besides rules for a single address, a rule can cover a whole domain, every subdomain of a domain,
+or any address matching a glob or regular expression:
+
+    news@example.com      exact address
+    @example.com          every address at example.com
+    *.example.com         every address at a subdomain of example.com (e.g. a@mail.example.com)
+    *@*.example.*         glob pattern
+    re:^noreply\\d*@       regular expression
+
+Rules are created with sender_store.add_label() (or unsubscribe()), which take any of the above in place
+of an email address. The Sender List page creates exact address rules, and domain rules when "Label every
+sender at @example.com" is ticked.
+
+Each rule has a single action: "Unsubscribed" if it has been unsubscribed from, whatever its labels, and
+otherwise the newest of its labels (see sender_store.get_sender_rules()). When more than one rule
+matches an address, the most specific one wins: an exact address rule first, then a domain rule, then
+subdomain rules from the longest domain to the shortest, and finally patterns. Between two matching
+patterns, the one that was created later wins.
+
+Rules are compiled once into hash tables keyed by address and by domain, so matching an address
+only looks up the address and each of its domain's suffixes, however many rules there are.
+"""
+
+import fnmatch
+import re
+
+PATTERN_PREFIX = "re:"
+GLOB_CHARACTERS = ("*", "?", "[")
+
+class RuleEngine:
+    def __init__(self, rules):
+        """
+        @param rules: dict mapping each rule (see above) to its label or "Unsubscribed",
+                      in the order the rules were created
+        """
+        self.exact = {}
+        self.domains = {}
+        self.subdomains = {}
+        self.patterns = []
+
+        for rule, action in rules.items():
+            self.add(rule, action)
+
+    def add(self, rule, action):
+        rule = rule.strip()
+        if rule.startswith(PATTERN_PREFIX):
+            self.patterns.append((re.compile(rule[len(PATTERN_PREFIX):], re.IGNORECASE), action, rule))
+            return
+
+        rule = rule.lower()
+        if rule.startswith("*.") and not any(c in rule[2:] for c in GLOB_CHARACTERS):
+            self.subdomains[rule[2:]] = action
+        elif any(c in rule for c in GLOB_CHARACTERS):
+            self.patterns.append((re.compile(fnmatch.translate(rule), re.IGNORECASE), action, rule))
+        elif rule.startswith("@"):
+            self.domains[rule[1:]] = action
+        else:
+            self.exact[rule] = action
+
+    def __len__(self):
+        return len(self.exact) + len(self.domains) + len(self.subdomains) + len(self.patterns)
+
+    def match(self, address):
+        """
+        Finds the rule that applies to an email address.
+
+        @param address: the sender's email address
+
+        @return: the rule's label or "Unsubscribed", or None if no rule applies
+        """
+        if not address:
+            return None
+        address = address.lower()
+
+        action = self.exact.get(address)
+        if action is not None:
+            return action
+
+        domain = address.rpartition("@")[2]
+        action = self.domains.get(domain)
+        if action is not None:
+            return action
+
+        if self.subdomains:
+            # Walk up from the longest parent domain: a.b.example.com -> b.example.com -> example.com -> com
+            suffix = domain
+            while "." in suffix:
+                suffix = suffix.partition(".")[2]
+                action = self.subdomains.get(suffix)
+                if action is not None:
+                    return action
+
+        for pattern, action, _ in reversed(self.patterns):
+            if pattern.match(address):
+                return action
+        return None
+
+    def searchable_domains(self):
+        """
+        @return: every domain covered by a domain or subdomain rule, for narrowing down
+                 which emails could match them with a server-side search
+        """
+        return list(dict.fromkeys(list(self.domains) + list(self.subdomains)))
+
+def domain_rule(address):
+    """
+    @return: the rule covering every address at the same domain as the given one, e.g. "@example.com"
+    """
+    return "@" + address.rpartition("@")[2].strip().lower()
+
+def compile_rules(rules):
+    """
+    @param rules: dict mapping each rule to its label or "Unsubscribed", e.g. from sender_store.get_sender_rules()
+
+    @return: RuleEngine for the rules
+    """
+    return RuleEngine(rules)
@@ -1,7 +1,7 @@
 """
 This script connects to a user's Gmail account, reading the headers of ALL emails in the target folder
-to extract the email address and display name for the sender of each email. It then stores this information in a JSON
-file 'senders.json'. For each email address entry in the 'senders.json' file, the frequency of emails
+to extract the email address and display name for the sender of each email. It then stores this information in the
+sender store (see sender_store.py). For each email address in the sender list, the frequency of emails
 received from each sender is included.
 
 Author: Michael Camerato
@@ -10,42 +10,63 @@ Date: 8/1/24
 """
 
 import imaplib
-import configparser
-import email
-import json
+import threading
+from bisect import bisect_right
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from multiprocessing import Pool, Manager
+from multiprocessing.util import Finalize
 import tqdm
 
+from .adaptive_concurrency import get_controller, is_throttle_error
+from . import sender_store
+from .header_parser import parse_from_header
+from .imap_connection import MAX_CONNECTIONS, borrow_connection, get_pool, select_mailbox
+from .uid_sets import (
+    chunk_uids, compress_uids, format_uid_ranges, parse_fetch_literals, parse_search_response, parse_uid_ranges, sort_uids
+)
 
-TARGET_FOLDER = '"[Gmail]/All Mail"'
-SENDERS_FILE = "src/data/senders.json"
-BATCH_SIZE = 10
 
-def establish_connection():
+TARGET_FOLDER = '"[Gmail]/All Mail"'
+CHECKPOINT_INTERVAL = 30  # seconds between saves of an in-progress scan's partial results
+PARTIAL_RESULTS_INTERVAL = 5  # seconds between the partial results handed to a results_callback
+BATCH_SIZE = 2000       # fixed for the process engine, the starting point for the thread engine
+POOL_SIZE = 10          # likewise, in connections
+# Most connections the thread engine will grow to. Gmail allows 15 per account, so the thread engine
+# borrows from the shared pool (MAX_CONNECTIONS) rather than opening connections on top of it.
+THREAD_POOL_SIZE = MAX_CONNECTIONS
+RECONNECT_ATTEMPTS = 3
+
+# "thread" scans with a thread pool sharing one process, "process" with a multiprocessing pool
+SCAN_ENGINE = "thread"
+
+# The connection held by the current worker process for its whole lifetime (see init_worker)
+_worker_mail = None
+
+def load_scan_state():
     """
-    Establishes a connection to the gmail server using the credentials in the config.ini file.
+    Loads the checkpoint left by the last completed scan.
 
-    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
+    @return: dict containing the "uidvalidity" of the target folder and the "last_uid" that was scanned,
+             or an empty dict if no scan has been completed
     """
+    return sender_store.get_meta("scan_state", {})
 
-    config = configparser.ConfigParser()
-    config.read("config.ini")
 
-    email_address = config["gmail"]["email"]
-    password = config["gmail"]["password"]
+def save_scan_state(uidvalidity, last_uid):
+    sender_store.set_meta("scan_state", {"uidvalidity": uidvalidity, "last_uid": last_uid})
 
-    for attempt in range(3):
-        try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            break
-        except Exception as e:
-            if attempt < 2:
-                print(f"Connection attempt {attempt+1} failed: {e}. Retrying...")
-            else:
-                raise Exception(f"Failed to connect to imap.gmail.com after {attempt+1} attempts: {e}")
-    mail.login(email_address, password)
-    mail.login(email_address, password)
-    return mail
+
+def reset_scan_state():
+    sender_store.delete_meta("scan_state")
+    sender_store.delete_scan_checkpoint()
+
+
+def has_scan_checkpoint():
+    """
+    @return: True if there is an unfinished scan for the next scan to resume
+    """
+    return sender_store.has_scan_checkpoint()
 
 
 def fetch_all_uids(mail):
@@ -55,53 +76,102 @@ def fetch_all_uids(mail):
     @return: list of email UIDs
     """
 
-    mail.select(TARGET_FOLDER)
-    _, data = mail.search(None, "ALL")
-    uids = data[0].split()
+    select_mailbox(mail, TARGET_FOLDER)
+    _, data = mail.uid("SEARCH", None, "ALL")
+    uids = parse_search_response(data)
     print(f"Found {len(uids)} emails in the target folder.")
     return uids
 
 
-def get_sender(email_msg):
+def fetch_new_uids(mail, last_uid):
+    """
+    Fetches a list of email UIDs for the emails that arrived in the target folder after the given UID.
+
+    @param last_uid: the highest UID that has already been scanned
+
+    @return: list of email UIDs
     """
-    Extracts the sender's name and email address from an email object.
 
-    @param email_msg: email object
+    select_mailbox(mail, TARGET_FOLDER)
+    _, data = mail.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+    # "n:*" always matches the newest email, even when its UID is lower than n
+    uids = [uid for uid in parse_search_response(data) if uid > last_uid]
+    print(f"Found {len(uids)} new emails in the target folder.")
+    return uids
+
 
-    @return: tuple containing the sender's name and email address
+def init_worker():
+    """
+    Initializer for the scan's worker processes. Each worker logs in once and keeps its
+    connection for every batch it processes, instead of logging in again for each batch.
     """
-    raw_sender = email_msg["From"]
-    name, email_address = email.utils.parseaddr(raw_sender)
-    return name, email_address
+    global _worker_mail
+    _worker_mail = None
 
+    try:
+        get_worker_connection()
+    except Exception as e:
+        # The connection will be retried when the worker receives its first batch.
+        print(f"Worker failed to connect: {e}")
 
-def process_batch(args):
+    Finalize(None, close_worker_connection, exitpriority=10)
+
+
+def get_worker_connection(reconnect=False):
     """
-    Helper function to process a batch of emails.
-    Designed to be used with multiprocessing.
+    Returns the current worker's connection, with the target folder selected.
 
-    @param args: Tuple containing the UID batch, the shared counter, and the should_cancel flag.
+    @param reconnect: True to throw away the current connection and log in again
+
+    @return: imaplib.IMAP4_SSL object representing the connection to the gmail server
+    """
+    global _worker_mail
+
+    if reconnect and _worker_mail is not None:
+        get_pool().checkin(_worker_mail, discard=True)
+        _worker_mail = None
+
+    if _worker_mail is None:
+        _worker_mail = get_pool().checkout()
+
+    select_mailbox(_worker_mail, TARGET_FOLDER)
+    return _worker_mail
+
+
+def close_worker_connection():
+    """
+    Logs out of the current worker's connection when the worker process exits.
+    """
+    global _worker_mail
+
+    if _worker_mail is not None:
+        get_pool().checkin(_worker_mail, discard=True)
+        _worker_mail = None
+
+
+def scan_batch(mail, uid_batch):
+    """
+    Reads the sender of each email in a batch, fetching the From header of the whole batch
+    with a single UID FETCH (or a few, if the batch's UID set is too long for one command).
+
+    @param mail: connection with the target folder selected
+    @param uid_batch: list of email UIDs
 
     @return: dictionary of senders with their email addresses and frequency counts.
     """
-    uid_batch, counter, should_cancel = args
     senders = {}
+    headers = []
 
-    mail = establish_connection()
-    if not mail: return {}
-    mail.select(TARGET_FOLDER)
+    for chunk in chunk_uids(uid_batch):
+        result, data = mail.uid("FETCH", compress_uids(chunk), "(UID BODY.PEEK[HEADER.FIELDS (FROM)])")
+        if result != "OK":
+            raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+        headers.extend(parse_fetch_literals(data))
 
-    for uid in uid_batch:
-        if should_cancel.value:
-            print("\nBatch processing cancelled.")
-            return senders
+    for uid, raw_header in headers:
         try:
-            uid = uid.decode()
-            _, data = mail.uid("fetch", uid, "(RFC822.HEADER)")
-            if not data or not data[0]: continue
-            raw_email = data[0][1]
-            email_msg = email.message_from_bytes(raw_email)
-            name, email_address = get_sender(email_msg)
+            name, email_address = parse_from_header(raw_header)
+            if not email_address: continue
 
             if email_address in senders:
                 senders[email_address]["frequency"] += 1
@@ -112,88 +182,421 @@ def process_batch(args):
                 }
         except Exception as e:
             print(f"Error processing email UID {uid}: {e}")
-    
-    counter.value += 1
-    mail.logout()
+
     return senders
 
 
-def merge_senders_dicts(dict_list):
+def process_batch(args):
     """
-    Merges a list of sender dictionaries into a single dictionary.
+    Helper function to process a batch of emails.
+    Designed to be used with multiprocessing, in a pool created with init_worker as its initializer.
+
+    If the worker's connection drops, it reconnects and the batch is scanned again from the start.
+    If the server throttles us, the worker waits before trying again.
 
-    @param dict_list: list of sender dictionaries
+    @param args: Tuple containing the UID batch and the should_cancel flag.
 
-    @return: merged dictionary of senders
+    @return: tuple containing the UID batch and the dictionary of senders with their email addresses
+             and frequency counts (None if the batch was skipped or cancelled).
     """
-    merged_senders = {}
-    for d in dict_list:
-        for email_address, info in d.items():
-            if email_address in merged_senders:
-                merged_senders[email_address]["frequency"] += info["frequency"]
-            else:
-                merged_senders[email_address] = info
-    return merged_senders
+    uid_batch, should_cancel = args
+
+    for attempt in range(RECONNECT_ATTEMPTS):
+        if should_cancel.value:
+            return uid_batch, None
+        try:
+            mail = get_worker_connection(reconnect=attempt > 0)
+            return uid_batch, scan_batch(mail, uid_batch)
+        except (imaplib.IMAP4.error, OSError) as e:
+            print(f"Worker batch failed: {e}. Retrying...")
+            if is_throttle_error(e):
+                time.sleep(2 ** attempt)
+
+    print(f"Skipping a batch of {len(uid_batch)} emails after {RECONNECT_ATTEMPTS} failed attempts.")
+    return uid_batch, None
 
 
-def scan_emails_parallel(uids, cancel_flag=None, progress_callback=None):
+def process_batch_threaded(pool, uid_batch, stop, controller):
     """
-    Scans the list of email UIDs for senders and their email addresses using parallel processing.
+    Helper function to process a batch of emails in the thread engine.
+
+    Connections are borrowed from the shared connection pool for each batch, so they stay
+    logged in and are reused by later batches. A batch whose connection drops is retried on a
+    new connection, and throttling responses are reported to the controller, which decides
+    how long to back off.
+
+    @param pool: the shared ConnectionPool
+    @param uid_batch: list of email UIDs
+    @param stop: threading.Event that is set when the scan is cancelled
+    @param controller: AdaptiveController for the scan
+
+    @return: tuple containing the UID batch and the dictionary of senders with their email addresses
+             and frequency counts (None if the batch was skipped or cancelled).
+    """
+    for attempt in range(RECONNECT_ATTEMPTS):
+        if stop.is_set():
+            return uid_batch, None
+        generation = controller.generation
+        try:
+            with pool.connection() as mail:
+                pool.select(mail, TARGET_FOLDER)
+                start = time.monotonic()
+                senders = scan_batch(mail, uid_batch)
+                controller.record_success(len(uid_batch), time.monotonic() - start, "FETCH", generation)
+                return uid_batch, senders
+        except (imaplib.IMAP4.error, OSError) as e:
+            print(f"Scan batch failed: {e}. Retrying...")
+            if is_throttle_error(e):
+                stop.wait(controller.record_throttle(generation))
+
+    print(f"Skipping a batch of {len(uid_batch)} emails after {RECONNECT_ATTEMPTS} failed attempts.")
+    return uid_batch, None
+
+
+def add_senders(total, senders):
+    """
+    Adds the frequency counts of one sender dictionary into another, in place.
+
+    @param total: sender dictionary to add to
+    @param senders: sender dictionary to add
+    """
+    for email_address, info in senders.items():
+        if email_address in total:
+            total[email_address]["frequency"] += info["frequency"]
+        else:
+            total[email_address] = dict(info)
+
+
+class ScanCheckpoint:
+    """
+    The partial results of an unfinished scan: the UIDs scanned so far and the senders found in them.
+    The checkpoint is saved in the sender store periodically and when the scan is cancelled, so that
+    the next scan can resume where this one stopped instead of starting over.
+
+    Each batch is a slice of the sorted list of UIDs being scanned, so the UIDs it covers are kept as a
+    single (first, last) range, and each batch's senders are folded into the running total as soon as
+    it finishes, so memory stays flat no matter how many batches the scan has. Only the senders found
+    since the last save are written by the next one. If a results_callback is set, it's handed a
+    snapshot of the running total every PARTIAL_RESULTS_INTERVAL seconds.
+    """
+    def __init__(self, uidvalidity, base_uid, completed=None, senders=None, scanned=None):
+        self.uidvalidity = uidvalidity
+        self.base_uid = base_uid
+        self.completed = sorted(completed or [])  # (first, last) range of each finished batch
+        self.senders = senders or {}
+        self.unsaved = {}  # senders found since the last save
+        self.saved = completed is not None  # False until this checkpoint replaces any other saved one
+        self.scanned = scanned if scanned is not None else sum(last - first + 1 for first, last in self.completed)
+        self.skipped = 0  # emails in batches that couldn't be scanned
+        self.results_callback = None
+        self.last_flush = time.monotonic()
+        self.last_publish = time.monotonic()
+
+    @classmethod
+    def load(cls, uidvalidity, base_uid):
+        """
+        Loads the saved checkpoint, if it belongs to a scan of the same folder starting from the same UID.
+
+        @param uidvalidity: UIDVALIDITY of the target folder
+        @param base_uid: the UID the scan starts after (0 for a full scan)
+
+        @return: the saved ScanCheckpoint, or an empty one if there is nothing to resume
+        """
+        state, senders = sender_store.get_scan_checkpoint()
+        if state and state.get("uidvalidity") == uidvalidity and state.get("base_uid") == base_uid:
+            return cls(uidvalidity, base_uid, parse_uid_ranges(state["completed"]), senders, state.get("scanned"))
+        return cls(uidvalidity, base_uid)
+
+    def record(self, uid_batch, senders):
+        """
+        Adds the results of a finished batch to the checkpoint.
+        Batches that weren't scanned (senders is None) are left for the next scan.
+        """
+        if senders is None:
+            self.skipped += len(uid_batch)
+            return
+        uid_batch = list(map(int, uid_batch))
+        self.add_range(min(uid_batch), max(uid_batch))
+        self.scanned += len(uid_batch)
+        add_senders(self.senders, senders)
+        add_senders(self.unsaved, senders)
+
+    def add_range(self, first, last):
+        """
+        Adds a finished batch's range of UIDs, merging it with the ranges it overlaps or touches.
+        A batch of a resumed scan may span ranges finished earlier, since they're left out of it.
+        """
+        completed = self.completed
+        start = end = bisect_right(completed, (first, last))
+        if start > 0 and completed[start - 1][1] >= first - 1:
+            start -= 1
+            first = completed[start][0]
+            last = max(last, completed[start][1])
+        while end < len(completed) and completed[end][0] <= last + 1:
+            last = max(last, completed[end][1])
+            end += 1
+        completed[start:end] = [(first, last)]
+
+    def remaining(self, uids):
+        """
+        @return: the UIDs from the given list that haven't been scanned yet, sorted
+        """
+        firsts = [first for first, _ in self.completed]
+        remaining = []
+        for uid in sort_uids(uids):
+            i = bisect_right(firsts, uid) - 1
+            if i < 0 or uid > self.completed[i][1]:
+                remaining.append(uid)
+        return remaining
+
+    def flush_if_due(self):
+        now = time.monotonic()
+        if self.results_callback and now - self.last_publish >= PARTIAL_RESULTS_INTERVAL:
+            self.publish()
+        if now - self.last_flush >= CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def publish(self):
+        """
+        Hands a copy of the senders found so far to the results_callback. The copy is taken on the
+        scanning thread, so the callback can read it from any thread while the scan keeps going.
+        """
+        self.results_callback({address: dict(info) for address, info in self.senders.items()})
+        self.last_publish = time.monotonic()
+
+    def flush(self):
+        """
+        Saves the checkpoint in the sender store, in a single transaction, so a crash
+        during the save leaves the previous checkpoint intact.
+        """
+        sender_store.save_scan_checkpoint({
+            "uidvalidity": self.uidvalidity,
+            "base_uid": self.base_uid,
+            "completed": format_uid_ranges(self.completed),
+            "scanned": self.scanned
+        }, self.unsaved, replace=not self.saved)
+        self.unsaved = {}
+        self.saved = True
+        self.last_flush = time.monotonic()
+
+    def clear(self):
+        sender_store.delete_scan_checkpoint()
+
+
+def scan_emails_parallel(uids, cancel_flag=None, progress_callback=None, checkpoint=None):
+    """
+    Scans the list of email UIDs for senders using a multiprocessing pool ("process" engine),
+    with a fixed POOL_SIZE and BATCH_SIZE.
 
     @param uids: list of email UIDs
     @param cancel_flag: threading.Event object to cancel the scan (optional)
-    @param progress_callback: function to call with the progress of the scan (optional)
-
-    Updates the senders.json file with a "sender" entry, which looks like this:
+    @param progress_callback: function to call with the progress of the scan, in emails (optional)
+    @param checkpoint: ScanCheckpoint that the results of each batch are recorded in
 
-        {
-            "Sender's Email Address": {
-                "name": "Sender's Name",
-                "frequency": # of emails found from sender
-            }
-        }
+    @return: True if every batch was scanned, False if the scan was cancelled
     """
     print("Scanning emails with parallel processing...")
 
     uid_batches = [uids[i:i + BATCH_SIZE] for i in range(0, len(uids), BATCH_SIZE)]
-    total_batches = len(uid_batches)
-
-    POOL_SIZE = 10
 
     with Manager() as manager:
-        counter = manager.Value('i', 0)
         should_cancel = manager.Value('b', False)
 
-        with Pool(POOL_SIZE) as pool:
-            args = [(batch, counter, should_cancel) for batch in uid_batches]
-            
-            with tqdm.tqdm(total=total_batches, desc="Processing batches...") as pbar:
-                results = []
-                for result in pool.imap_unordered(process_batch, args):
-                    if cancel_flag and cancel_flag.is_set():
-                        should_cancel.value = True
-                        pool.terminate()
-                        print("\nScan cancelled...\n")
-                        return
-                    results.append(result)
-                    pbar.update(1)
+        with Pool(POOL_SIZE, initializer=init_worker) as pool:
+            args = ((batch, should_cancel) for batch in uid_batches)
+
+            with tqdm.tqdm(total=len(uids), desc="Scanning emails...") as pbar:
+                try:
+                    for uid_batch, senders in pool.imap_unordered(process_batch, args):
+                        checkpoint.record(uid_batch, senders)
+                        if cancel_flag and cancel_flag.is_set():
+                            should_cancel.value = True
+                            pool.terminate()
+                            checkpoint.flush()
+                            print("\nScan cancelled, progress saved...\n")
+                            return False
+                        checkpoint.flush_if_due()
+                        pbar.update(len(uid_batch))
+                        if progress_callback:
+                            progress_callback(pbar.format_dict['n'] / len(uids), pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+                except BaseException:
+                    checkpoint.flush()
+                    raise
+
+            # Let the workers exit normally so they can log out of their connections
+            pool.close()
+            pool.join()
+
+    return True
+
+
+def scan_emails_threaded(uids, cancel_flag=None, progress_callback=None, checkpoint=None):
+    """
+    Scans the list of email UIDs for senders using a thread pool ("thread" engine).
+
+    The scan is network-bound, so threads get the same parallelism as worker processes
+    without the cost of starting interpreters or proxying shared state between them.
+    Progress is only counted by the calling thread, so it needs no locking.
+
+    The number of batches in flight and the size of each new batch come from the scan's
+    AdaptiveController, so they grow while throughput improves and shrink when Gmail pushes back.
+
+    @param uids: list of email UIDs
+    @param cancel_flag: threading.Event object to cancel the scan (optional)
+    @param progress_callback: function to call with the progress of the scan, in emails (optional)
+    @param checkpoint: ScanCheckpoint that the results of each batch are recorded in
+
+    @return: True if every batch was scanned, False if the scan was cancelled
+    """
+    print("Scanning emails with threads...")
+
+    controller = get_controller(
+        "Sender Scan",
+        workers=min(POOL_SIZE, THREAD_POOL_SIZE),
+        max_workers=THREAD_POOL_SIZE,
+        batch_size=BATCH_SIZE,
+        min_batch_size=200,
+        max_batch_size=10000,
+        batch_step=500
+    )
+    stop = threading.Event()
+    pool = get_pool()
+    executor = ThreadPoolExecutor(max_workers=controller.max_workers)
+    pending = {}
+    position = 0
+
+    try:
+        with tqdm.tqdm(total=len(uids), desc="Scanning emails...") as pbar:
+            while pending or position < len(uids):
+                while position < len(uids) and len(pending) < controller.workers:
+                    uid_batch = uids[position:position + controller.batch_size]
+                    position += len(uid_batch)
+                    pending[executor.submit(process_batch_threaded, pool, uid_batch, stop, controller)] = uid_batch
+
+                # Wake up regularly, so a cancel doesn't have to wait for the next batch to finish
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    uid_batch, senders = future.result()
+                    checkpoint.record(uid_batch, senders)
+                    pbar.update(len(uid_batch))
                     if progress_callback:
-                        progress_callback(counter.value / total_batches, pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+                        progress_callback(pbar.format_dict['n'] / len(uids), pbar.format_dict['n'], pbar.format_dict['total'], pbar.format_dict['rate'], pbar.format_dict['elapsed'])
+
+                if cancel_flag and cancel_flag.is_set():
+                    stop.set()
+                    checkpoint.flush()
+                    print("\nScan cancelled, progress saved...\n")
+                    return False
+                checkpoint.flush_if_due()
+    except BaseException:
+        stop.set()
+        checkpoint.flush()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return True
+
+
+def scan_emails(uids, cancel_flag=None, progress_callback=None, incremental=False, checkpoint=None, engine=SCAN_ENGINE,
+  results_callback=None):
+    """
+    Scans the list of email UIDs for senders and their email addresses.
 
-        senders = merge_senders_dicts(results)
+    @param uids: list of email UIDs
+    @param cancel_flag: threading.Event object to cancel the scan (optional)
+    @param progress_callback: function to call with the progress of the scan (optional)
+    @param incremental: True to add the new frequency counts to the existing sender list, False to replace it
+    @param checkpoint: ScanCheckpoint to record progress in, so the scan can be resumed if it's
+                       cancelled or crashes. Its partial results are included in the final counts. (optional)
+    @param engine: "thread" or "process" (see SCAN_ENGINE)
+    @param results_callback: function to call with the senders found so far while the scan runs (optional)
 
-        with open(SENDERS_FILE, "w") as file:
-            json.dump(senders, file, indent=4)
+    @return: the dictionary of senders found by this scan, or None if the scan was cancelled or some
+             batches couldn't be scanned (their progress is kept in the checkpoint, to be retried by the next scan)
 
-    print("\nEmails successfully scanned! Scan results saved in 'senders.json' file.\n")
+    The senders are saved in the sender store (see sender_store.py). The dictionary looks like this:
 
+        {
+            "Sender's Email Address": {
+                "name": "Sender's Name",
+                "frequency": # of emails found from sender
+            }
+        }
+    """
+    if checkpoint is None:
+        checkpoint = ScanCheckpoint(None, None)
+    elif checkpoint.completed:
+        print(f"Resuming scan, {checkpoint.scanned} emails were already scanned.")
+    checkpoint.results_callback = results_callback
+
+    scan_engine = scan_emails_threaded if engine == "thread" else scan_emails_parallel
+    if not scan_engine(uids, cancel_flag, progress_callback, checkpoint):
+        return None
+
+    # Saving now would lose the skipped emails for good, since the next scan would start after them
+    if checkpoint.skipped:
+        checkpoint.flush()
+        print(f"\n{checkpoint.skipped} emails couldn't be scanned, progress saved. Scan again to retry them.\n")
+        return None
+
+    # Only the new counts are written; the existing senders never have to be loaded
+    if incremental:
+        sender_store.add_sender_counts(checkpoint.senders)
+    else:
+        sender_store.replace_senders(checkpoint.senders)
+
+    checkpoint.clear()
+    print("\nEmails successfully scanned! Scan results saved in the sender store.\n")
+    return checkpoint.senders
+
+
+def scan_for_senders(cancel_flag=None, progress_callback=None, full_rescan=False, engine=SCAN_ENGINE, results_callback=None):
+    """
+    Scans the target folder for senders. If a previous scan completed and the folder's UIDVALIDITY
+    hasn't changed since, only the emails that arrived after that scan are scanned, and their
+    senders are merged into the existing sender list. A scan that was cancelled or crashed is
+    resumed from its last checkpoint.
 
-def scan_for_senders(cancel_flag=None, progress_callback=None):
+    @param cancel_flag: threading.Event object to cancel the scan (optional)
+    @param progress_callback: function to call with the progress of the scan (optional)
+    @param full_rescan: True to ignore the previous scan and rescan every email
+    @param engine: "thread" or "process" (see SCAN_ENGINE)
+    @param results_callback: function to call with the senders found so far while the scan runs (optional)
+
+    @return: True if the scan finished, False if it was cancelled or some emails couldn't be scanned
+    """
     print("Email scan iniitiated...")
-    mail = establish_connection()
-    uids = fetch_all_uids(mail)
-    mail.logout()
-    scan_emails_parallel(uids, cancel_flag, progress_callback)
+    state = {} if full_rescan else load_scan_state()
+    has_senders = sender_store.has_senders() if state else False
+
+    with borrow_connection() as mail:
+        # Always re-SELECT here, so that a UIDVALIDITY change can't be hidden by a cached selection
+        get_pool().invalidate_selection(mail)
+        select_mailbox(mail, TARGET_FOLDER)
+        uidvalidity = get_pool().selected_uidvalidity(mail)
+
+        incremental = has_senders and state.get("uidvalidity") == uidvalidity
+        if incremental:
+            uids = fetch_new_uids(mail, state["last_uid"])
+            last_uid = state["last_uid"]
+        else:
+            if has_senders: print("The target folder's UIDVALIDITY changed, rescanning every email...")
+            uids = fetch_all_uids(mail)
+            last_uid = 0
+
+    if uids:
+        checkpoint = ScanCheckpoint.load(uidvalidity, last_uid)
+        remaining_uids = checkpoint.remaining(uids)
+        if scan_emails(remaining_uids, cancel_flag, progress_callback, incremental, checkpoint, engine, results_callback) is None:
+            return False
+        last_uid = max(int(uid) for uid in uids)
+    else:
+        print("\nNo new emails to scan.\n")
+
+    save_scan_state(uidvalidity, last_uid)
+    return True
 
 def main():
     scan_for_senders()
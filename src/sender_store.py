@@ -0,0 +1,355 @@
+"""
+This file contains the sender store, the SQLite database that holds the sender list, the sender rules
+(labels and unsubscribes) and the metadata of the scan and the organizers (e.g. an unfinished scan's
+checkpoint, and each job's delta sync state).
+
+They used to live in senders.json, sender_labels.json and unsubscribed.json, which were read in full and
+rewritten in full every time a single rule changed. With the database, adding a label or unsubscribing
+from a sender only touches that sender's row, and looking up a sender's rule is an indexed query.
+The JSON files are imported into the database the first time it's opened.
+
+Every thread gets its own connection (SQLite connections can't be shared between threads), and the
+database runs in WAL mode, so the Sender List can keep reading while a scan is writing.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from .header_parser import decode_encoded_words
+
+DATABASE_FILE = "src/data/email_organizer.db"
+
+# The JSON files imported into the database the first time it's opened
+SENDERS_FILE = "src/data/senders.json"
+SENDER_LABELS_FILE = "src/data/sender_labels.json"
+UNSUBSCRIBED_FILE = "src/data/unsubscribed.json"
+SCAN_STATE_FILE = "src/data/scan_state.json"
+
+# Entries of the "Filter by Label" dropdown that aren't labels
+FILTER_PLACEHOLDERS = ["Filter by Label", "---"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS senders (
+    address TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    frequency INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS labels (
+    address TEXT NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (address, label)
+);
+CREATE INDEX IF NOT EXISTS labels_by_label ON labels (label);
+CREATE TABLE IF NOT EXISTS unsubscribed (
+    address TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS scan_senders (
+    address TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    frequency INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+_setup_lock = threading.Lock()
+
+def get_connection():
+    """
+    Returns the current thread's connection to the database, opening it (and creating and migrating
+    the database, if needed) on first use.
+
+    @return: sqlite3.Connection
+    """
+    db = getattr(_local, "db", None)
+    # A forked child process must not use the parent's connection
+    if db is not None and _local.pid == os.getpid():
+        return db
+
+    db = sqlite3.connect(DATABASE_FILE, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    with _setup_lock:
+        with db:
+            db.executescript(SCHEMA)
+        migrate_json_files(db)
+
+    _local.db = db
+    _local.pid = os.getpid()
+    return db
+
+def _load_json(path, default):
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            try: return json.load(file)
+            except json.JSONDecodeError: return default
+    return default
+
+def migrate_json_files(db):
+    """
+    Imports senders.json, sender_labels.json, unsubscribed.json and scan_state.json into the database.
+    Sender names saved by older versions are decoded on the way in.
+    This only happens once; the files are left in place but are no longer used afterwards.
+    """
+    if db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+        return
+
+    senders = _load_json(SENDERS_FILE, {})
+    sender_labels = _load_json(SENDER_LABELS_FILE, {})
+    unsubscribed = _load_json(UNSUBSCRIBED_FILE, {})
+    scan_state = _load_json(SCAN_STATE_FILE, {})
+
+    with db:
+        if isinstance(senders, dict):
+            db.executemany(
+                "INSERT OR REPLACE INTO senders (address, name, frequency) VALUES (?, ?, ?)",
+                ((address, decode_encoded_words(info.get("name", "")).strip(), info.get("frequency", 0))
+                 for address, info in senders.items())
+            )
+        if isinstance(sender_labels, dict):
+            db.executemany(
+                "INSERT OR IGNORE INTO labels (address, label) VALUES (?, ?)",
+                ((address, label) for label, addresses in sender_labels.items()
+                 if label not in FILTER_PLACEHOLDERS for address in addresses)
+            )
+        db.executemany("INSERT OR IGNORE INTO unsubscribed (address) VALUES (?)", ((address,) for address in unsubscribed))
+        if scan_state:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_state', ?)", (json.dumps(scan_state),))
+        db.execute("INSERT INTO meta (key, value) VALUES ('migrated', '1')")
+
+    print("Sender Store > Imported the sender list and sender rules from the JSON files")
+
+# ----------------------------------------------------------------------------------------------------------------
+# Senders
+
+def get_senders(label=None, search=None):
+    """
+    Fetches the sender list, sorted by name.
+
+    @param label: only return the senders that have been assigned this label (optional)
+    @param search: only return the senders whose address or name contains this text, ignoring case (optional)
+
+    @return: list of (email address, {"name": ..., "frequency": ...}) tuples
+    """
+    query = "SELECT s.address, s.name, s.frequency FROM senders s"
+    conditions, params = [], []
+    if label is not None:
+        query += " JOIN labels l ON l.address = s.address"
+        conditions.append("l.label = ?")
+        params.append(label)
+    if search:
+        conditions.append("(instr(lower(s.address), ?) > 0 OR instr(lower(s.name), ?) > 0)")
+        params.extend([search.lower(), search.lower()])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY s.name"
+
+    rows = get_connection().execute(query, params)
+    return [(address, {"name": name, "frequency": frequency}) for address, name, frequency in rows]
+
+def has_senders():
+    return get_connection().execute("SELECT 1 FROM senders LIMIT 1").fetchone() is not None
+
+def add_sender_counts(senders):
+    """
+    Adds the frequency counts of a sender dictionary to the sender list, in a single transaction.
+    Senders that aren't in the list yet are added, with their name.
+
+    @param senders: dictionary of senders, as built by the sender scan
+    """
+    db = get_connection()
+    with db:
+        db.executemany(
+            "INSERT INTO senders (address, name, frequency) VALUES (?, ?, ?) "
+            "ON CONFLICT (address) DO UPDATE SET frequency = frequency + excluded.frequency",
+            ((address, info["name"], info["frequency"]) for address, info in senders.items())
+        )
+
+def replace_senders(senders):
+    """
+    Replaces the whole sender list with a sender dictionary, in a single transaction.
+    """
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM senders")
+        db.executemany(
+            "INSERT INTO senders (address, name, frequency) VALUES (?, ?, ?)",
+            ((address, info["name"], info["frequency"]) for address, info in senders.items())
+        )
+
+def delete_sender(address):
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM senders WHERE address = ?", (address,))
+
+def reset_senders():
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM senders")
+
+# ----------------------------------------------------------------------------------------------------------------
+# Sender rules
+
+def add_label(address, label):
+    """
+    Assigns a label to a sender rule.
+
+    @param address: an email address, or a rule covering many of them: "@example.com" for a domain,
+                    "*.example.com" for its subdomains, a glob, or "re:" and a regular expression (see rule_engine.py)
+    @param label: the label's name
+    """
+    db = get_connection()
+    with db:
+        db.execute("INSERT OR IGNORE INTO labels (address, label) VALUES (?, ?)", (address, label))
+
+def get_label_names():
+    """
+    @return: list of every label that has been assigned to a sender, in the order they were first used
+    """
+    rows = get_connection().execute("SELECT label FROM labels GROUP BY label ORDER BY min(rowid)")
+    return [label for (label,) in rows]
+
+def get_sender_labels():
+    """
+    @return: dict mapping each label to the list of email addresses assigned to it
+    """
+    sender_labels = {}
+    for address, label in get_connection().execute("SELECT address, label FROM labels ORDER BY rowid"):
+        sender_labels.setdefault(label, []).append(address)
+    return sender_labels
+
+def reset_labels():
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM labels")
+
+def unsubscribe(address):
+    db = get_connection()
+    with db:
+        db.execute("INSERT OR IGNORE INTO unsubscribed (address) VALUES (?)", (address,))
+
+def resubscribe(address):
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM unsubscribed WHERE address = ?", (address,))
+
+def is_unsubscribed(address):
+    return get_connection().execute("SELECT 1 FROM unsubscribed WHERE address = ?", (address,)).fetchone() is not None
+
+def get_unsubscribed():
+    """
+    @return: list of the email addresses that have been unsubscribed from
+    """
+    return [address for (address,) in get_connection().execute("SELECT address FROM unsubscribed ORDER BY rowid")]
+
+def reset_unsubscribed():
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM unsubscribed")
+
+def get_sender_rules():
+    """
+    Fetches every sender rule. When a sender has more than one label, the newest one is used,
+    and unsubscribing from a sender overrides its labels. The rules are in the order they were first created.
+
+    @return: dict mapping each email address (or other rule, see add_label()) to its label, or to "Unsubscribed"
+    """
+    rules = {}
+    for address, label in get_connection().execute("SELECT address, label FROM labels ORDER BY rowid"):
+        rules[address] = label
+    for address in get_unsubscribed():
+        rules[address] = "Unsubscribed"
+    return rules
+
+def has_rules():
+    db = get_connection()
+    return (db.execute("SELECT 1 FROM labels LIMIT 1").fetchone() is not None
+            or db.execute("SELECT 1 FROM unsubscribed LIMIT 1").fetchone() is not None)
+
+# ----------------------------------------------------------------------------------------------------------------
+# Metadata
+
+def get_meta(key, default=None):
+    """
+    Reads a value saved with set_meta().
+
+    @return: the value, or default if nothing has been saved under the key
+    """
+    row = get_connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_meta(key, value):
+    """
+    Saves a JSON serializable value under a key.
+    """
+    db = get_connection()
+    with db:
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+def update_meta(key, update, default=None):
+    """
+    Reads, changes and saves a value in a single transaction, so that two updates made at the
+    same time (e.g. by two jobs committing their sync state) can't overwrite each other.
+
+    @param update: function given the current value (or default) that returns the new value
+    """
+    db = get_connection()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        value = update(json.loads(row[0]) if row else default)
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+def delete_meta(key):
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+# ----------------------------------------------------------------------------------------------------------------
+# Scan checkpoint
+
+def get_scan_checkpoint():
+    """
+    @return: tuple containing the state saved by save_scan_checkpoint() (None if there is no checkpoint)
+             and the dictionary of senders the unfinished scan found
+    """
+    db = get_connection()
+    state = get_meta("scan_checkpoint")
+    if state is None:
+        return None, {}
+    rows = db.execute("SELECT address, name, frequency FROM scan_senders")
+    return state, {address: {"name": name, "frequency": frequency} for address, name, frequency in rows}
+
+def has_scan_checkpoint():
+    return get_meta("scan_checkpoint") is not None
+
+def save_scan_checkpoint(state, senders, replace=False):
+    """
+    Saves an unfinished scan's progress, in a single transaction. Only the senders found since the
+    last save are written, and their counts are added to the ones already saved.
+
+    @param state: JSON serializable state of the scan (e.g. the UIDs it has scanned so far)
+    @param senders: dictionary of the senders found since the last save
+    @param replace: True to discard the checkpoint saved by a different scan first
+    """
+    db = get_connection()
+    with db:
+        if replace:
+            db.execute("DELETE FROM scan_senders")
+        db.executemany(
+            "INSERT INTO scan_senders (address, name, frequency) VALUES (?, ?, ?) "
+            "ON CONFLICT (address) DO UPDATE SET frequency = frequency + excluded.frequency",
+            ((address, info["name"], info["frequency"]) for address, info in senders.items())
+        )
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_checkpoint', ?)", (json.dumps(state),))
+
+def delete_scan_checkpoint():
+    db = get_connection()
+    with db:
+        db.execute("DELETE FROM scan_senders")
+        db.execute("DELETE FROM meta WHERE key = 'scan_checkpoint'")
@@ -0,0 +1,167 @@
+"""
+This file contains helpers for working with IMAP UID sets, so that commands can address
+many emails at once (e.g. "1:500,502,510:900") instead of a single UID per command.
+
+It turns lists of UIDs into compact sequence sets, splits large lists into chunks whose
+sequence sets are short enough to send in one command, and parses the UIDs out of
+SEARCH and FETCH responses. Everything works on sorted lists of ints in a single pass,
+so it stays fast on mailboxes with millions of emails.
+"""
+
+import re
+from itertools import compress, count, islice, repeat
+from operator import lt, ne, sub
+
+# Most characters of sequence set to put in one command. Servers are only required to accept
+# command lines of around 8000 octets, and the rest of the command needs some room too.
+MAX_SET_LENGTH = 7000
+
+FETCH_UID_REGEX = re.compile(rb'UID (\d+)')
+MODSEQ_REGEX = re.compile(rb'\(MODSEQ \d+\)')
+
+def sort_uids(uids):
+    """
+    @param uids: list of UIDs, as ints or as the bytes returned by imaplib
+
+    @return: sorted list of the distinct UIDs, as ints
+    """
+    if not isinstance(uids, (list, tuple, set, frozenset)):
+        uids = list(uids)
+    if uids and not isinstance(next(iter(uids)), int):
+        uids = list(map(int, uids))
+    # SEARCH responses are usually sorted already, which only takes one pass to check
+    if isinstance(uids, list) and all(map(lt, uids, islice(uids, 1, None))):
+        return uids
+    return sorted(set(uids))
+
+def _run_breaks(uids):
+    """
+    Finds where the runs of consecutive UIDs in a sorted list start. The work is done by
+    itertools and operator, so no Python code runs per UID.
+
+    @return: list of the indexes (other than 0) at which a new run starts
+    """
+    return list(compress(count(1), map(ne, map(sub, islice(uids, 1, None), uids), repeat(1))))
+
+def _range_text(first, last):
+    return f"{first}:{last}" if first != last else f"{first}"
+
+def compress_uids(uids):
+    """
+    Turns a list of UIDs into a compact IMAP sequence set string.
+
+    @param uids: list of UIDs, as ints or as the bytes returned by imaplib
+
+    @return: sequence set string, e.g. "1:500,502,510:900"
+    """
+    uids = sort_uids(uids)
+    if not uids:
+        return ""
+    breaks = _run_breaks(uids)
+    firsts = [uids[0]]
+    firsts += map(uids.__getitem__, breaks)
+    lasts = list(map(uids.__getitem__, map(sub, breaks, repeat(1))))
+    lasts.append(uids[-1])
+    return ",".join([f"{first}:{last}" if first != last else f"{first}" for first, last in zip(firsts, lasts)])
+
+def chunk_uids(uids, size=None, max_length=MAX_SET_LENGTH):
+    """
+    Splits a list of UIDs into sorted chunks, so that a command over many emails can be sent
+    as several commands of a manageable size.
+
+    @param uids: list of UIDs, as ints or as the bytes returned by imaplib
+    @param size: most UIDs to put in each chunk (optional)
+    @param max_length: most characters the sequence set of each chunk may have once compressed
+
+    @return: list of chunks, each a sorted list of UIDs as ints
+    """
+    uids = sort_uids(uids)
+    if not uids:
+        return []
+    size = size or len(uids)
+    chunks = []
+    chunk_start = 0
+    length = 0
+
+    breaks = _run_breaks(uids)
+    for start, end in zip([0] + breaks, breaks + [len(uids)]):
+        while start < end:
+            take = min(end - start, size - (start - chunk_start))
+            if take > 0:
+                piece = len(_range_text(uids[start], uids[start + take - 1])) + (1 if length else 0)
+            if take == 0 or (length and length + piece > max_length):
+                chunks.append(uids[chunk_start:start])
+                chunk_start = start
+                length = 0
+                continue
+            length += piece
+            start += take
+
+    chunks.append(uids[chunk_start:])
+    return chunks
+
+def parse_uid_ranges(uid_set):
+    """
+    Turns an IMAP sequence set string into its ranges, without expanding them into every UID.
+
+    @param uid_set: sequence set, e.g. "1:3,7" (as str or bytes)
+
+    @return: list of (first, last) tuples of ints, e.g. [(1, 3), (7, 7)]
+    """
+    if isinstance(uid_set, bytes):
+        uid_set = uid_set.decode()
+
+    ranges = []
+    for part in uid_set.strip().split(","):
+        if part:
+            first, _, last = part.partition(":")
+            ranges.append(tuple(sorted((int(first), int(last or first)))))
+    return ranges
+
+def format_uid_ranges(ranges):
+    """
+    @param ranges: list of (first, last) tuples of ints
+
+    @return: sequence set string, e.g. "1:3,7"
+    """
+    return ",".join(_range_text(first, last) for first, last in ranges)
+
+def parse_search_response(data):
+    """
+    Parses the UIDs (or sequence numbers) out of the response to a SEARCH, including the
+    "(MODSEQ n)" that CONDSTORE servers add to it.
+
+    @param data: data returned by mail.uid("SEARCH", ...)
+
+    @return: list of UIDs as ints
+    """
+    uids = []
+    for item in data or []:
+        if item:
+            uids.extend(map(int, MODSEQ_REGEX.sub(b"", item).split()))
+    return uids
+
+def parse_fetch_literals(data):
+    """
+    Parses the response to a FETCH of a literal item (e.g. a header or a body) for many emails at once.
+
+    imaplib returns each email's literal as a (prefix, literal) tuple, where the prefix looks like
+    b'12 (UID 345 BODY[HEADER.FIELDS (FROM)] {52}'. The UID may also come after the literal,
+    in the bytes item that follows the tuple (e.g. b' UID 345)').
+
+    @param data: data returned by mail.uid("FETCH", ...)
+
+    @return: list of (uid, literal bytes) tuples, where uid is None if the response didn't include it
+    """
+    literals = []
+
+    for i, item in enumerate(data or []):
+        if not isinstance(item, tuple):
+            continue
+        prefix, literal = item
+        match = FETCH_UID_REGEX.search(prefix)
+        if not match and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            match = FETCH_UID_REGEX.search(data[i + 1])
+        literals.append((int(match.group(1)) if match else None, literal))
+
+    return literals